@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from wrangling_scripts import wrangle_data as wd
+from benchmarks.synthetic_data import generate_covid_data, BASE_REGIONS, BASE_DAYS
+
+
+def _touch(path):
+    '''
+    This function gives a file a new modification time, which makes it a new data version, so that
+    the processed dataset and its snapshot are built again.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        this function does not return anything
+    '''
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+
+def stages():
+    '''
+    This function lists the benchmarked stages of the wrangling pipeline. Each stage is a pair of a setup
+    function, which prepares the input and is not timed, and the timed function, which gets the input.
+
+    The 'cold' stages start from a new data version, so they include reading the csv files; 'snapshot'
+    starts from a new process' point of view with a current snapshot on disk; the other prepare and figure
+    stages reuse the processed dataset of the current data version.
+
+    Args:
+        None
+
+    Returns:
+        stages (list): list of (name, setup, run) tuples
+    '''
+
+    def merged():
+        return wd.merge_data()
+
+    def full():
+        return wd.add_calculated_cols(wd.merge_data())
+
+    def latest():
+        return wd.dates_choice(full())
+
+    def new_version():
+        _touch(wd.DATA_PATH)
+
+    def snapshot_only():
+        # dropping the processed dataset of this process, keeping the snapshot on disk
+        wd._processed['key'] = None
+
+    def warm():
+        wd.get_processed_data()
+
+    return [
+        ('get_popdata', lambda: None, lambda _: wd.get_popdata(wd.POPDATA_PATH)),
+        ('get_country_dimension', lambda: None, lambda _: wd.get_country_dimension(wd.POPDATA_PATH)),
+        ('get_covid_data', lambda: wd.get_country_dimension(wd.POPDATA_PATH)[1],
+         lambda country_ids: wd.get_covid_data(wd.DATA_PATH, country_ids=country_ids)),
+        ('merge_data', lambda: None, lambda _: wd.merge_data()),
+        ('add_calculated_cols', merged, wd.add_calculated_cols),
+        ('rolling_cols', full,
+         lambda df: wd._add_rolling_cols(df, wd._segment_starts(df['Country_id'].values))),
+        ('dates_choice_daily', full, lambda df: wd.dates_choice(df, all_dates=True)),
+        ('dates_choice_weekly', full, lambda df: wd.dates_choice(df, weekly=True)),
+        ('dates_choice_latest', full, wd.dates_choice),
+        ('rank_data', latest, lambda df: wd.rank_data(df, ('Total_deaths', 10))),
+        ('ranking_index_daily', lambda: wd.dates_choice(full(), all_dates=True),
+         lambda df: wd.ranking_index(df, 'Total_deaths')),
+        ('get_processed_data_cold', new_version, lambda _: wd.get_processed_data()),
+        ('get_processed_data_snapshot', snapshot_only, lambda _: wd.get_processed_data()),
+        ('prepare_barplot', warm, lambda _: wd.prepare_barplot()),
+        ('prepare_time', warm, lambda _: wd.prepare_time(top_n=('Total_deaths', 15))),
+        ('prepare_time_weekly', warm, lambda _: wd.prepare_time_weekly(top_n=('Deaths_week', 10))),
+        ('return_figures_cold', new_version, lambda _: wd.return_figures(workers=0)),
+        ('return_figures_cold_threads', new_version, lambda _: wd.return_figures(workers=5, pool='thread')),
+        ('return_figures_cold_processes', new_version, lambda _: wd.return_figures(workers=5, pool='process')),
+        ('return_figures_warm', warm, lambda _: wd.return_figures(workers=0)),
+    ]
+
+
+def run_stage(setup, run, repeat):
+    '''
+    This function times one stage. The time is the best of repeat runs; the peak memory is measured with
+    tracemalloc in one extra run, since tracing slows the code down.
+
+    Args:
+        setup (function): prepares the input of the stage
+        run (function): the stage, called with the input
+        repeat (int): number of timed runs
+
+    Returns:
+        result (dict): 'seconds' (best time) and 'peak_bytes' (memory allocated at peak)
+    '''
+
+    times = []
+
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        run(data)
+        times.append(time.perf_counter() - start)
+
+    data = setup()
+    tracemalloc.start()
+    run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+
+def run_benchmarks(scales, repeat=3, days_scale=False, only=None):
+    '''
+    This function runs all stages on synthetic data at every scale. Scale 1 is about the size of the real
+    data (190 countries and regions, 470 days); scale 10 has ten times as many regions, or ten times as many
+    days if days_scale is True.
+
+    Each scale runs in its own temporary directory holding a 'data' folder, so the default data paths of the
+    wrangling functions point at the synthetic files and nothing in the repository is touched.
+
+    Args:
+        scales (list): scale factors, for instance [1, 10, 100]
+        repeat (int) (optional): number of timed runs per stage
+        days_scale (boolean) (optional): True to scale the number of days instead of the number of regions
+        only (list) (optional): names of the stages to run, all if None
+
+    Returns:
+        results (dict): environment description and the results per scale and stage
+    '''
+
+    popdata_path = os.path.abspath(wd.POPDATA_PATH)
+    cwd = os.getcwd()
+
+    results = {'python': platform.python_version(),
+               'pandas': pd.__version__,
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'repeat': repeat,
+               'runs': []}
+
+    for scale in scales:
+
+        n_regions = BASE_REGIONS * (1 if days_scale else scale)
+        n_days = BASE_DAYS * (scale if days_scale else 1)
+
+        work_dir = tempfile.mkdtemp(prefix='bench-')
+
+        try:
+            os.chdir(work_dir)
+            os.makedirs(os.path.dirname(wd.DATA_PATH))
+            shutil.copyfile(popdata_path, wd.POPDATA_PATH)
+
+            rows = generate_covid_data(wd.DATA_PATH, n_regions=n_regions, n_days=n_days, popdata_path=popdata_path)
+
+            run = {'scale': scale, 'regions': n_regions, 'days': n_days, 'rows': rows, 'stages': {}}
+
+            for name, setup, stage in stages():
+                if only and name not in only:
+                    continue
+                run['stages'][name] = run_stage(setup, stage, repeat)
+                print('scale {:>4}  {:<28} {:>9.4f} s {:>10.1f} MB'.format(
+                    scale, name, run['stages'][name]['seconds'], run['stages'][name]['peak_bytes'] / 1e6),
+                    file=sys.stderr)
+
+            results['runs'].append(run)
+
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    This function compares results with those of an earlier run (for instance before a pandas upgrade)
+    and lists the stages that got slower by more than the threshold factor.
+
+    Args:
+        results (dict): results of run_benchmarks
+        baseline (dict): earlier results of run_benchmarks
+        threshold (float): factor, for instance 1.25 for 25 % slower
+
+    Returns:
+        regressions (list): (scale, stage, baseline seconds, seconds) for every regression
+    '''
+
+    earlier = {(run['scale'], name): stage['seconds']
+               for run in baseline['runs'] for name, stage in run['stages'].items()}
+
+    regressions = []
+
+    for run in results['runs']:
+        for name, stage in run['stages'].items():
+            before = earlier.get((run['scale'], name))
+            if before and stage['seconds'] > threshold * before:
+                regressions.append((run['scale'], name, before, stage['seconds']))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the wrangling pipeline on synthetic data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='scale factors relative to the real data (default: 1 10)')
+    parser.add_argument('--days', action='store_true', help='scale the number of days instead of regions')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (default: 3)')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slow-down factor reported as a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, repeat=args.repeat, days_scale=args.days, only=args.stages)
+
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+        for scale, name, before, after in regressions:
+            print('REGRESSION scale {} {}: {:.4f} s -> {:.4f} s'.format(scale, name, before, after), file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
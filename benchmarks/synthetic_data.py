@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from wrangling_scripts.wrangle_data import get_popdata, POPDATA_PATH
+
+
+# the size of the real data: about 190 rows (countries and regions) per day, for about 470 days
+BASE_REGIONS = 190
+BASE_DAYS = 470
+
+# names the covid-19 data uses for some countries, instead of the ones in the population dataset
+RAW_COUNTRY_NAMES = {'United Kingdom': 'UK',
+                     'United States': 'US',
+                     'China': 'Mainland China',
+                     'Czechia': 'Czech Republic',
+                     'Gambia': 'The Gambia'}
+
+
+def generate_covid_data(data_path, n_regions=BASE_REGIONS, n_days=BASE_DAYS, seed=0, popdata_path=POPDATA_PATH):
+    '''
+    This function writes a synthetic covid-19 data file shaped like the Johns Hopkins data.
+
+    The regions are spread over the countries of the population dataset; the first region of a country
+    has no 'Province/State', the others are named 'Region 1', 'Region 2' etc. Every region starts on a
+    random day within the first 60 days and then reports cumulative deaths every day. Rows are ordered by
+    date, like in the real file, and some countries use the names of the real file (for instance 'US').
+
+    Args:
+        data_path (str): path of the csv file to write
+        n_regions (int) (optional): number of countries and regions reporting
+        n_days (int) (optional): number of days, starting 22nd of January 2020
+        seed (int) (optional): seed of the random numbers
+        popdata_path (str) (optional): path to the population data file
+
+    Returns:
+        rows (int): number of rows written
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    countries = get_popdata(popdata_path)['Country'].replace(RAW_COUNTRY_NAMES).values
+
+    region_ids = np.arange(n_regions)
+    region_country = countries[region_ids % len(countries)]
+    region_province = np.array([''] + ['Region {}'.format(i) for i in range(1, n_regions // len(countries) + 1)],
+                               dtype=object)[region_ids // len(countries)]
+
+    # days x regions: active once the region has started reporting, with cumulative deaths
+    start_day = rng.integers(0, 60, n_regions)
+    active = np.arange(n_days)[:, None] >= start_day[None, :]
+
+    daily = rng.poisson(rng.uniform(0, 20, n_regions), size=(n_days, n_regions)) * active
+    deaths = np.cumsum(daily, axis=0)
+
+    day_idx, region_idx = np.nonzero(active)
+
+    dates = pd.date_range('2020-01-22', periods=n_days)
+    observation_date = dates.strftime('%m/%d/%Y')[day_idx]
+    last_update = dates.strftime('%Y-%m-%d %H:%M:%S')[day_idx]
+
+    total = deaths[day_idx, region_idx].astype(np.float64)
+
+    df = pd.DataFrame({'SNo': np.arange(1, len(day_idx) + 1),
+                       'ObservationDate': observation_date,
+                       'Province/State': region_province[region_idx],
+                       'Country/Region': region_country[region_idx],
+                       'Last Update': last_update,
+                       'Confirmed': total * 30,
+                       'Deaths': total,
+                       'Recovered': total * 20})
+
+    df.to_csv(data_path, index=False)
+
+    return len(df)
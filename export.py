@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+from flask import render_template
+from pandemic2020 import app
+from wrangling_scripts.wrangle_data import FIGURES, return_figures, data_version
+from wrangling_scripts.payload import dumps_figure
+
+# default output directory of the static site, and the file in it recording what was exported
+EXPORT_DIR = 'site'
+MANIFEST_NAME = 'export.json'
+
+
+def _write_file(path, body):
+    '''
+    This function writes a file next to its final path first and then moves it into place, so a static
+    server never serves a half-written file. The file is readable by other users, such as the static server.
+
+    Args:
+        path (str): path of the file
+        body (bytes): content of the file
+
+    Returns:
+        this function does not return anything
+    '''
+
+    # mkstemp creates a file only its owner can read
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    os.chmod(tmp_path, 0o644)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+def export_site(output_dir=EXPORT_DIR, force=False):
+    '''
+    This function exports the dashboard as a static site that any static file server or CDN can host:
+
+    - figures/figure-<n>.<hash>.json: the JSON of every figure, named after a hash of its content
+    - index.html: the page, which fetches the figures from those files as they are scrolled into view
+    - static/: the images of the page
+
+    The export is incremental. A figure whose JSON has not changed keeps its file name, so browsers keep
+    using their cached copy, and only changed figures are written. Files of figures that the new index.html
+    no longer uses are kept for one more export, since visitors who loaded the previous page still fetch
+    them; they are listed as 'previous' in export.json and removed by the next export. If the source data
+    has not changed since the last export, nothing is built at all.
+
+    The time series figures are exported as built; zooming in on them does not fetch more points, since
+    there is no server to fetch them from.
+
+    Args:
+        output_dir (str) (optional): directory of the site
+        force (boolean) (optional): True to build the figures even if the data has not changed
+
+    Returns:
+        written (list): paths of the files that were written
+    '''
+
+    version = json.loads(json.dumps(data_version()))
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if (not force and manifest and manifest['version'] == version
+            and all(os.path.exists(os.path.join(output_dir, url)) for url in manifest['figures'])):
+        return []
+
+    figures_dir = os.path.join(output_dir, 'figures')
+    os.makedirs(figures_dir, exist_ok=True)
+
+    written = []
+    urls = []
+
+    for i, figure in enumerate(return_figures()):
+
+        body = dumps_figure(figure).encode('utf-8')
+        url = 'figures/figure-{}.{}.json'.format(i, hashlib.sha1(body).hexdigest()[:12])
+
+        path = os.path.join(output_dir, url)
+        if not os.path.exists(path):
+            _write_file(path, body)
+            written.append(path)
+
+        urls.append(url)
+
+    shutil.copytree(app.static_folder, os.path.join(output_dir, 'static'), dirs_exist_ok=True)
+
+    # the page shell of progressive mode, loading the figures from their files
+    with app.app_context():
+        html = render_template('index.html',
+                               ids=['figure-{}'.format(i) for i, _ in enumerate(FIGURES)],
+                               figuresJSON=None,
+                               zoomable=[],
+                               figure_urls=urls).encode('utf-8')
+
+    index_path = os.path.join(output_dir, 'index.html')
+    try:
+        with open(index_path, 'rb') as f:
+            unchanged = f.read() == html
+    except OSError:
+        unchanged = False
+
+    if not unchanged:
+        _write_file(index_path, html)
+        written.append(index_path)
+
+    # the figures of the previous page stay until the next export; older ones are removed
+    previous = [url for url in (manifest['figures'] if manifest else []) if url not in urls]
+
+    for name in os.listdir(figures_dir):
+        url = 'figures/' + name
+        if url not in urls and url not in previous:
+            os.remove(os.path.join(figures_dir, name))
+
+    _write_file(manifest_path, json.dumps({'version': version, 'figures': urls, 'previous': previous},
+                                          indent=2).encode('utf-8'))
+
+    return written
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Export the dashboard as a static site.')
+    parser.add_argument('output_dir', nargs='?', default=EXPORT_DIR,
+                        help='directory of the site (default: {})'.format(EXPORT_DIR))
+    parser.add_argument('--force', action='store_true', help='build the figures even if the data has not changed')
+    args = parser.parse_args()
+
+    written = export_site(args.output_dir, args.force)
+
+    for path in written:
+        print(path)
+
+    print('{} file(s) written to {}'.format(len(written), args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
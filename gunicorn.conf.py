@@ -0,0 +1,21 @@
+import os
+
+# the app is imported once in the master and the workers are forked from it (PANDEMIC_PRELOAD=0 to
+# import it in every worker instead). The setting is passed on to the app, see pandemic2020/__init__.py
+os.environ.setdefault('PANDEMIC_PRELOAD', '1')
+preload_app = os.environ['PANDEMIC_PRELOAD'] == '1'
+
+
+def when_ready(server):
+    # runs in the master once it listens, before the workers are forked: they start with the dataset,
+    # the figures and the rendered page in memory they share with the master
+    if preload_app:
+        from pandemic2020 import warm_up
+        server.log.info('Warming up')
+        warm_up()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from pandemic2020 import start_ingest
+        start_ingest()
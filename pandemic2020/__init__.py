@@ -1,5 +1,68 @@
+import os
 from flask import Flask
 
 app = Flask(__name__)
 
-from pandemic2020 import routes
+from pandemic2020 import routes, api
+
+# preload mode (PANDEMIC_PRELOAD=1, the default in gunicorn.conf.py): gunicorn imports the app in the master
+# process and forks the workers from it, so the workers share the data built by 'warm_up'
+PRELOAD = os.environ.get('PANDEMIC_PRELOAD') == '1'
+
+
+def start_ingest():
+    '''
+    This function starts the optional background data refresh: PANDEMIC_INGEST_SOURCE is 'kaggle' or the
+    path of a drop directory, and PANDEMIC_INGEST_INCREMENTAL=1 only calculates the new dates on each refresh.
+    Every process may start it; only one of them ingests at a time (see 'start_ingest_worker'), and the
+    others pick up the new data from its snapshot on their next request.
+
+    Args:
+        None
+
+    Returns:
+        this function does not return anything
+    '''
+
+    if os.environ.get('PANDEMIC_INGEST_SOURCE'):
+        from wrangling_scripts.ingest import start_ingest_worker
+        start_ingest_worker(os.environ['PANDEMIC_INGEST_SOURCE'],
+                            interval=int(os.environ.get('PANDEMIC_INGEST_INTERVAL', 3600)),
+                            incremental=os.environ.get('PANDEMIC_INGEST_INCREMENTAL') == '1',
+                            single=True)
+
+
+def warm_up():
+    '''
+    This function builds everything the first requests need: the processed dataset, the index page with
+    its figures (or every figure on its own in progressive mode) and the date selections of the API.
+    Run in the gunicorn master before the workers are forked, no user request pays for the first load.
+
+    Without data (for instance on a first deploy, before the ingest worker has fetched it) there is nothing
+    to warm up; that is logged and skipped, so that the workers start and their ingest worker can run.
+
+    Args:
+        None
+
+    Returns:
+        this function does not return anything
+    '''
+
+    try:
+        with app.app_context():
+            if routes.PROGRESSIVE:
+                for i, _ in enumerate(routes.FIGURES):
+                    routes.render_figure(i)
+            routes.render_index()
+
+        for kind in ['latest', 'daily', 'weekly']:
+            api.get_indexed_data(kind)
+
+    except FileNotFoundError as e:
+        app.logger.warning('Skipping warm-up, no data yet: %s', e)
+
+
+# threads do not survive a fork, so in preload mode the ingest thread is started in every worker
+# by the post_fork hook in gunicorn.conf.py instead
+if not PRELOAD:
+    start_ingest()
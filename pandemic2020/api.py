@@ -0,0 +1,304 @@
+from pandemic2020 import app
+import json
+import functools
+import numpy as np
+import pandas as pd
+from flask import jsonify, request
+from wrangling_scripts.wrangle_data import get_derived, get_selection, top_countries, data_version, \
+    CONTINENTS, VAR_LIST, LEVEL_NAMES
+
+DEFAULT_PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
+# number of distinct query results kept in memory
+QUERY_CACHE_SIZE = 256
+
+# the data version the cached query results belong to
+_query_version = {'version': None}
+
+# the columns returned besides the metrics, per level of the data
+ID_COLS = {'region': ['Date', 'Region', 'Province', 'Country', 'ISO', 'Continent'],
+           'country': ['Date', 'Country', 'ISO', 'Continent'],
+           'continent': ['Date', 'Continent']}
+
+
+def get_indexed_data(kind, level='country'):
+    '''
+    This function returns the dataset behind an API endpoint, indexed for fast lookups of a series
+    (a country, or a region or continent for the other levels) and a date. It is built once per
+    data version from the processed dataset.
+
+    - 'latest': the latest date, indexed by the series name
+    - 'daily': all dates, indexed by the series name then Date
+    - 'weekly': the weekly rows (see 'weekly_snapshot'), indexed by the series name then Date
+
+    Args:
+        kind (str): 'latest', 'daily' or 'weekly'
+        level (str) (optional): 'region', 'country' or 'continent'
+
+    Returns:
+        df (dataframe): indexed dataset, sorted on its index
+    '''
+
+    name = LEVEL_NAMES[level]
+    index = [name] if kind == 'latest' else [name, 'Date']
+
+    return get_derived('api_{}_{}'.format(level, kind), lambda df_full: get_selection(kind, level).reset_index().set_index(
+        index, drop=False).sort_index())
+
+
+def get_series_bounds(kind, level='country'):
+    '''
+    This function lists the series of the indexed dataset (see 'get_indexed_data'), with the rows each
+    one spans: the dataset is sorted on the series name, so the rows of a series are one range. It is
+    built once per data version from the index.
+
+    Args:
+        kind (str): 'latest', 'daily' or 'weekly'
+        level (str) (optional): 'region', 'country' or 'continent'
+
+    Returns:
+        series (dataframe): 'start', 'stop' (the rows of the series) and the 'Country' (not on the continent
+                            level) and 'Continent' of each series, indexed by the series name
+    '''
+
+    def build(df_full):
+
+        df = get_indexed_data(kind, level)
+
+        if isinstance(df.index, pd.MultiIndex):
+            codes = df.index.codes[0]
+            starts = np.flatnonzero(np.diff(codes, prepend=-1))
+            names = df.index.levels[0][codes[starts]]
+        else:
+            starts = np.arange(len(df))
+            names = df.index
+
+        series = pd.DataFrame({'start': starts, 'stop': np.append(starts[1:], len(df))}, index=names)
+
+        for col in ['Country', 'Continent']:
+            if col in df:
+                series[col] = np.asarray(df[col])[starts]
+
+        return series
+
+    return get_derived('api_{}_{}_series'.format(level, kind), build)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def run_query(version, kind, level, continent, countries, top, n, start, end):
+    '''
+    This function answers an API query from the indexed dataset. Results are cached per data version
+    and query, so a repeated query is a cache lookup. A result is the range of rows of every series in it,
+    so it takes a few bytes per series; the rows of a page are only turned into records when they are
+    asked for (see '_page_records').
+
+    Countries are ranked on the 'top' metric at the latest date of the selection with the ranking index,
+    like 'prepare_time' does, and the result is ordered by that ranking (or by country name when there is no ranking), then date.
+    On the region and continent levels the same goes for regions or continents instead of countries.
+
+    Args:
+        version (tuple): data version, see 'data_version'
+        kind (str): 'latest', 'daily' or 'weekly'
+        level (str): 'region', 'country' or 'continent'
+        continent (str): continent to filter on, or None
+        countries (tuple): countries to filter on, or None
+        top (str): metric to rank the countries on, or None
+        n (int): number of top ranked countries to keep, or None for all
+        start (str): first date (YYYY-MM-DD), or None
+        end (str): last date (YYYY-MM-DD), or None
+
+    Returns:
+        result (dict): 'countries' (list of series names in result order), 'rows' ([series, 2] array with
+                       the first and the end row of every series in the indexed dataset) and 'df' (the
+                       indexed dataset)
+    '''
+
+    df = get_indexed_data(kind, level)
+    series = get_series_bounds(kind, level)
+
+    # the filters look at one row per series
+    if countries:
+        series = series[series['Country'].isin(countries)]
+
+    if continent:
+        series = series[series['Continent'].values == continent]
+
+    first = series['start'].values
+    stop = series['stop'].values
+
+    # the dates of a series are sorted, so a date range is a binary search in each of its ranges
+    if kind != 'latest' and (start or end):
+        dates = df['Date'].values
+        first, stop = first.copy(), stop.copy()
+        for i in range(len(series)):
+            segment = dates[first[i]:stop[i]]
+            offset = first[i]
+            if start:
+                first[i] = offset + np.searchsorted(segment, np.datetime64(pd.Timestamp(start)), side='left')
+            if end:
+                stop[i] = offset + np.searchsorted(segment, np.datetime64(pd.Timestamp(end)), side='right')
+
+    found = stop > first
+    series = pd.DataFrame({'start': first[found], 'stop': stop[found]}, index=series.index[found])
+
+    if top:
+        names = set(series.index) if countries else None
+        date = df['Date'].values[series['stop'].values - 1].max() if len(series) else pd.NaT
+        countrylist = top_countries(top, n, date, kind, continent, names, level)
+        series = series.reindex(countrylist).dropna().astype(np.int64)
+    else:
+        countrylist = list(series.index)
+
+    return {'countries': countrylist, 'rows': series[['start', 'stop']].values, 'df': df}
+
+
+def _page_records(result, first, count, columns):
+    '''
+    This function turns the rows of one page of a query result into records.
+
+    Args:
+        result (dict): query result (see 'run_query')
+        first (int): position of the first row of the page in the result
+        count (int): number of rows of the page
+        columns (list): the columns of the records
+
+    Returns:
+        records (list): one dict per row
+    '''
+
+    rows = result['rows']
+    offsets = np.append(0, np.cumsum(rows[:, 1] - rows[:, 0]))
+
+    positions = []
+
+    for i in range(max(np.searchsorted(offsets, first, side='right') - 1, 0), len(rows)):
+        if offsets[i] >= first + count:
+            break
+        positions.append(np.arange(rows[i, 0] + max(first - offsets[i], 0),
+                                   rows[i, 0] + min(first + count, offsets[i + 1]) - offsets[i]))
+
+    df = result['df'].iloc[np.concatenate(positions) if positions else []][columns]
+
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+def _parse_args(kind):
+    '''
+    This function reads and checks the query parameters of an API request:
+
+    - level: 'country' (default), 'region' (province/state) or 'continent'
+    - continent: one of CONTINENTS
+    - countries: comma separated country names
+    - top and n: rank on the metric top and keep the n first countries
+    - start and end: date range (YYYY-MM-DD), not for 'latest'
+    - metrics: comma separated metric columns to return, all by default
+    - page and per_page: pagination
+
+    Args:
+        kind (str): 'latest', 'daily' or 'weekly'
+
+    Returns:
+        query (dict): arguments for 'run_query'
+        page (int), per_page (int)
+    '''
+
+    args = request.args
+
+    level = args.get('level') or 'country'
+    if level not in LEVEL_NAMES:
+        raise ValueError('level must be one of: {}'.format(', '.join(LEVEL_NAMES)))
+
+    available = [var for var in VAR_LIST if var in get_indexed_data(kind, level).columns]
+
+    continent = args.get('continent') or None
+    if continent and continent not in CONTINENTS:
+        raise ValueError('continent must be one of: {}'.format(', '.join(CONTINENTS)))
+
+    countries = tuple(c.strip() for c in args['countries'].split(',')) if args.get('countries') else None
+    if countries and level == 'continent':
+        raise ValueError('countries can not be used with level continent')
+
+    top = args.get('top') or None
+    if top and top not in available:
+        raise ValueError('top must be one of: {}'.format(', '.join(available)))
+
+    n = args.get('n', type=int)
+    if n is not None and n < 1:
+        raise ValueError('n must be a positive integer')
+
+    start, end = args.get('start') or None, args.get('end') or None
+    for date in (start, end):
+        if date:
+            try:
+                pd.Timestamp(date)
+            except ValueError:
+                raise ValueError('start and end must be dates (YYYY-MM-DD)')
+
+    metrics = tuple(m.strip() for m in args['metrics'].split(',')) if args.get('metrics') else tuple(available)
+    unknown = [m for m in metrics if m not in available]
+    if unknown:
+        raise ValueError('unknown metrics: {}'.format(', '.join(unknown)))
+
+    page = args.get('page', 1, type=int)
+    per_page = min(args.get('per_page', DEFAULT_PER_PAGE, type=int), MAX_PER_PAGE)
+    if page < 1 or per_page < 1:
+        raise ValueError('page and per_page must be positive integers')
+
+    query = dict(kind=kind, level=level, continent=continent, countries=countries, top=top, n=n,
+                 start=start, end=end, metrics=metrics)
+
+    return query, page, per_page
+
+
+def _respond(kind):
+    '''
+    This function answers an API request with one page of the query result as JSON.
+
+    Args:
+        kind (str): 'latest', 'daily' or 'weekly'
+
+    Returns:
+        response: JSON response, or a 400 response with an 'error' message for invalid parameters
+    '''
+
+    try:
+        query, page, per_page = _parse_args(kind)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    version = data_version()
+
+    # the results of an older data version would keep its dataset in memory
+    if _query_version['version'] != version:
+        run_query.cache_clear()
+        _query_version['version'] = version
+
+    metrics = query.pop('metrics')
+    result = run_query(version, **query)
+
+    total = int((result['rows'][:, 1] - result['rows'][:, 0]).sum())
+    first = (page - 1) * per_page
+
+    return jsonify(level=query['level'],
+                   countries=result['countries'],
+                   total=total,
+                   page=page,
+                   per_page=per_page,
+                   pages=(total + per_page - 1) // per_page,
+                   data=_page_records(result, first, per_page, ID_COLS[query['level']] + list(metrics)))
+
+
+@app.route('/api/latest')
+def api_latest():
+    return _respond('latest')
+
+
+@app.route('/api/timeseries')
+def api_timeseries():
+    return _respond('daily')
+
+
+@app.route('/api/weekly')
+def api_weekly():
+    return _respond('weekly')
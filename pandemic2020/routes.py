@@ -1,20 +1,356 @@
 from pandemic2020 import app
-import json, plotly
-from flask import render_template
-from wrangling_scripts.wrangle_data import return_figures
+import os
+import gzip
+import time
+import hashlib
+import threading
+import functools
+import pandas as pd
+from flask import render_template, request, Response, abort
+from wrangling_scripts.wrangle_data import FIGURES, SERIES_FIGURES, POINT_BUDGET, return_figure, return_figures, \
+    data_version
+from wrangling_scripts import instrumentation
+from wrangling_scripts.payload import dumps_figure
+from wrangling_scripts.geometry import geometry_path, geometry_version, tolerance_for_zoom
+from wrangling_scripts.instrumentation import timer, count
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# progressive mode (PANDEMIC_PROGRESSIVE=1): the index page is only the page shell, and every figure
+# is fetched from /figure/<n> by the browser when it is scrolled into view
+PROGRESSIVE = os.environ.get('PANDEMIC_PROGRESSIVE') == '1'
+
+# how long (in seconds) the previous version of the page or a figure may still be served after the data has
+# changed, while a single background thread builds the new one (PANDEMIC_MAX_STALENESS, 0 by default: every
+# request waits for the new version). Once that time is up, requests wait for the build instead.
+MAX_STALENESS = float(os.environ.get('PANDEMIC_MAX_STALENESS', 0))
+
+# the rendered index page, and the JSON of every figure, for the latest data version they were built for,
+# encoded in every content encoding with their ETag (see 'single_flight'). Each figure has its own state,
+# so the figures are built independently of each other
+_page_state = {'lock': threading.Lock(), 'version': None, 'value': None, 'pending': None, 'seen': None}
+_figure_states = [{'lock': threading.Lock(), 'version': None, 'value': None, 'pending': None, 'seen': None}
+                  for _ in FIGURES]
+
+
+def single_flight(state, version, build, cache, stale_ok=True):
+    '''
+    This function returns the value built for a data version, building it only once however many requests
+    ask for it at the same time: the first request that sees a new version builds it, and the others wait
+    for that build rather than starting their own. If the build fails, they all get its error.
+
+    With MAX_STALENESS the waiting requests, and the first one too, are served the value of the previous
+    version instead while the new one is built in a background thread (stale-while-revalidate), for at
+    most MAX_STALENESS seconds after the new version was first seen.
+
+    Args:
+        state (dict): 'lock', the 'version' and 'value' last built, the build in progress ('pending')
+                      and when the newest version was first seen ('seen')
+        version (tuple): data version, see 'data_version'
+        build (function): builds the value for version
+        cache (str): name of the cache for the metrics
+        stale_ok (boolean) (optional): False to always wait for the value of version
+
+    Returns:
+        value: the value built for version, or for the previous version while that is fresh enough
+    '''
+
+    with state['lock']:
+
+        if state['version'] == version:
+            count('pandemic_cache_requests_total', cache=cache, result='hit')
+            return state['value']
+
+        if state['seen'] is None or state['seen'][0] != version:
+            state['seen'] = (version, time.monotonic())
+
+        pending = state['pending']
+        builder = pending is None or pending['version'] != version
+
+        if builder:
+            pending = {'version': version, 'done': threading.Event()}
+            state['pending'] = pending
+
+        fresh = stale_ok and time.monotonic() - state['seen'][1] < MAX_STALENESS
+        stale = state['value'] if fresh else None
+
+    count('pandemic_cache_requests_total', cache=cache, result='miss' if stale is None else 'stale')
+
+    if stale is not None:
+        if builder:
+            threading.Thread(target=_build, args=(state, pending, build, True), daemon=True).start()
+        return stale
+
+    if builder:
+        return _build(state, pending, build)
+
+    pending['done'].wait()
+
+    if 'error' in pending:
+        raise pending['error']
+
+    return pending['value']
+
+
+def _build(state, pending, build, background=False):
+    '''
+    This function runs a build started by 'single_flight' and stores its value as the latest one in state.
+    The requests waiting for the build find its value, or its error, in pending.
+
+    Args:
+        state (dict): see 'single_flight'
+        pending (dict): the build: 'version' and 'done' (event set once the build is over)
+        build (function): builds the value for the version
+        background (boolean) (optional): True to log an error rather than raise it
+
+    Returns:
+        value: the built value
+    '''
+
+    try:
+        value = build()
+
+    except Exception as e:
+        pending['error'] = e
+        with state['lock']:
+            if state['pending'] is pending:
+                state['pending'] = None
+        if not background:
+            raise
+        app.logger.exception('Building for data version %s failed', pending['version'])
+
+    else:
+        pending['value'] = value
+        with state['lock']:
+            # a build for an older version finishing late does not replace a newer value
+            if state['pending'] is pending:
+                state['version'], state['value'], state['pending'] = pending['version'], value, None
+        return value
+
+    finally:
+        pending['done'].set()
+
+
+def encode_body(body):
+    '''
+    This function compresses a response body in every supported content encoding.
+
+    Args:
+        body (bytes): the response body
+
+    Returns:
+        cached (dict): ETag and the body per content encoding
+    '''
+
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+    if brotli:
+        bodies['br'] = brotli.compress(body)
+
+    return {'etag': hashlib.sha1(body).hexdigest(), 'bodies': bodies}
+
+
+def cached_response(cached, mimetype):
+    '''
+    This function answers a request with a body from encode_body: 304 if the client has it already,
+    otherwise the best content encoding the client accepts.
+
+    Args:
+        cached (dict): ETag and bodies, see 'encode_body'
+        mimetype (str): mimetype of the body
+
+    Returns:
+        response (Response)
+    '''
+
+    # the ETag is weak because the same body is sent with different content encodings
+    if request.if_none_match.contains_weak(cached['etag']):
+        response = Response(status=304)
+
+    else:
+        encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in cached['bodies']])
+
+        response = Response(cached['bodies'][encoding or 'identity'], mimetype=mimetype)
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(cached['etag'], weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+
+def render_figure(i, built=None, stale_ok=True):
+    '''
+    This function returns figure i for the current data version. The figure is only built, serialized and
+    compressed the first time it is requested after the data has changed, once for all concurrent requests
+    (see 'single_flight').
+
+    Args:
+        i (int): index of the figure in FIGURES
+        built (dict) (optional): the figure, if it has been built already
+        stale_ok (boolean) (optional): False to not be served the previous version (see 'single_flight')
+
+    Returns:
+        figure (dict): ETag, figure JSON and the JSON body per content encoding
+    '''
+
+    def build():
+        # Convert the plotly figure to JSON for javascript
+        with timer('pandemic_stage_seconds', stage='json_dumps'):
+            figureJSON = dumps_figure(return_figure(i) if built is None else built)
+
+        return dict(encode_body(figureJSON.encode('utf-8')), figureJSON=figureJSON)
+
+    return single_flight(_figure_states[i], data_version(), build, 'figure', stale_ok)
+
+
+@functools.lru_cache(maxsize=64)
+def render_window(version, i, start, end):
+    '''
+    This function returns time series figure i for a zoomed-in date window, at full resolution. The most
+    recently requested windows are cached per data version.
+
+    Args:
+        version (tuple): data version, see 'data_version'
+        i (int): index of the figure in FIGURES
+        start (str): first date of the window, or None
+        end (str): last date of the window, or None
+
+    Returns:
+        figure (dict): ETag and the JSON body per content encoding
+    '''
+
+    figureJSON = dumps_figure(return_figure(i, start=start, end=end))
+
+    return encode_body(figureJSON.encode('utf-8'))
+
+
+@functools.lru_cache(maxsize=8)
+def render_geometry(path, version):
+    '''
+    This function returns a built geometry file (see 'wrangling_scripts.geometry'), read once per
+    version of the file and kept in memory in every content encoding. It is not parsed; the bytes
+    are sent as they are.
+
+    Args:
+        path (str): path of the GeoJSON file
+        version (tuple): version of the file, see 'geometry_version'
+
+    Returns:
+        geometry (dict): ETag and the GeoJSON body per content encoding
+    '''
+
+    with open(path, 'rb') as f:
+        return encode_body(f.read())
+
+
+def render_index():
+    '''
+    This function returns the index page for the current data version. The page is only rendered and
+    compressed the first time it is requested after the data has changed, once for all concurrent requests
+    (see 'single_flight'). In progressive mode the page holds no figures; otherwise the figures are
+    embedded in it.
+
+    Args:
+        None
+
+    Returns:
+        page (dict): ETag, figures JSON and the page body per content encoding
+    '''
+
+    version = data_version()
+
+    def build():
+
+        # plot ids for the html id tag
+        ids = ['figure-{}'.format(i) for i, _ in enumerate(FIGURES)]
+
+        if PROGRESSIVE:
+            figuresJSON = None
+        else:
+            # the figures that are not cached yet are built together, in parallel if so configured
+            missing = [i for i, _ in enumerate(FIGURES) if _figure_states[i]['version'] != version]
+            built = dict(zip(missing, return_figures(missing)))
+
+            # the same JSON as dumping the list of figures at once
+            figuresJSON = '[' + ', '.join(render_figure(i, built.get(i), stale_ok=False)['figureJSON']
+                                          for i, _ in enumerate(FIGURES)) + ']'
+
+        # with downsampled time series, zooming in on these figures fetches the window at full resolution
+        zoomable = [i for i, figure in enumerate(FIGURES) if figure in SERIES_FIGURES] if POINT_BUDGET else []
+
+        # the page may be rendered in a background thread, outside of the request
+        with app.app_context():
+            html = render_template('index.html',
+                                   ids=ids,
+                                   figuresJSON=figuresJSON,
+                                   zoomable=zoomable).encode('utf-8')
+
+        return dict(encode_body(html), figuresJSON=figuresJSON)
+
+    return single_flight(_page_state, version, build, 'page')
+
 
 @app.route('/')
 @app.route('/index')
 def index():
 
-    figures = return_figures()
+    return cached_response(render_index(), 'text/html')
+
+
+@app.route('/figure/<int:i>')
+def figure(i):
+
+    if not 0 <= i < len(FIGURES):
+        abort(404)
+
+    # a date window (start and/or end, YYYY-MM-DD) is only available for the time series figures
+    start, end = request.args.get('start') or None, request.args.get('end') or None
+
+    if start or end:
+
+        if FIGURES[i] not in SERIES_FIGURES:
+            abort(404)
+
+        try:
+            start, end = [date and pd.Timestamp(date).strftime('%Y-%m-%d') for date in (start, end)]
+        except ValueError:
+            abort(400)
+
+        return cached_response(render_window(data_version(), i, start, end), 'application/json')
+
+    return cached_response(render_figure(i), 'application/json')
+
+
+@app.route('/geometry')
+def geometry():
+
+    # the level of detail follows the zoom level of the map (plotly's geo projection scale)
+    try:
+        zoom = float(request.args.get('zoom', 1))
+    except ValueError:
+        abort(400)
+
+    path = geometry_path(tolerance_for_zoom(zoom))
+    version = geometry_version(path)
+
+    # only available once the geometry has been built with 'python -m wrangling_scripts.geometry'
+    if version is None:
+        abort(404)
+
+    return cached_response(render_geometry(path, version), 'application/geo+json')
+
 
-    # plot ids for the html id tag
-    ids = ['figure-{}'.format(i) for i, _ in enumerate(figures)]
+@app.route('/metrics')
+def metrics():
 
-    # Convert the plotly figures to JSON for javascript in html template
-    figuresJSON = json.dumps(figures, cls=plotly.utils.PlotlyJSONEncoder)
+    # only available when instrumentation is switched on with PANDEMIC_METRICS=1
+    if not instrumentation.ENABLED:
+        abort(404)
 
-    return render_template('index.html',
-                           ids=ids,
-                           figuresJSON=figuresJSON)
+    return Response(instrumentation.render_prometheus(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import generate_covid_data
+from wrangling_scripts.wrangle_data import POPDATA_PATH, merge_data, add_calculated_cols, append_calculated_cols
+from wrangling_scripts.ingest import history_unchanged
+
+
+@pytest.fixture(scope='module')
+def df_merged(tmp_path_factory):
+    data_path = str(tmp_path_factory.mktemp('data') / 'covid_19_data.csv')
+    generate_covid_data(data_path, n_regions=300, n_days=120, popdata_path=POPDATA_PATH)
+    return merge_data(data_path, POPDATA_PATH)
+
+
+def assert_append_equals_full(df_merged, cut):
+    df_stored = add_calculated_cols(df_merged[df_merged['Date'] <= cut])
+
+    pd.testing.assert_frame_equal(append_calculated_cols(df_stored, df_merged), add_calculated_cols(df_merged))
+
+
+@pytest.mark.parametrize('days', [1, 3, 10])
+def test_append_equals_full_recompute(df_merged, days):
+    assert_append_equals_full(df_merged, df_merged['Date'].max() - pd.Timedelta(days=days))
+
+
+def test_append_with_date_gaps(df_merged):
+    rng = np.random.default_rng(1)
+    df_gaps = df_merged[rng.random(len(df_merged)) > 0.1].reset_index(drop=True)
+
+    assert_append_equals_full(df_gaps, df_gaps['Date'].max() - pd.Timedelta(days=5))
+
+
+def test_append_with_late_starting_countries(df_merged):
+    cut = df_merged['Date'].max() - pd.Timedelta(days=5)
+    ids = df_merged['Country_id'].unique()
+    late = df_merged['Country_id'].isin([ids[0], ids[len(ids) // 2], ids[-1]]) & (df_merged['Date'] <= cut)
+
+    assert_append_equals_full(df_merged[~late].reset_index(drop=True), cut)
+
+
+def test_append_without_new_dates(df_merged):
+    df_full = add_calculated_cols(df_merged)
+
+    assert append_calculated_cols(df_full, df_merged) is df_full
+
+
+def test_history_unchanged_with_late_starting_countries(df_merged):
+    cut = df_merged['Date'].max() - pd.Timedelta(days=5)
+    ids = df_merged['Country_id'].unique()
+    late = df_merged['Country_id'].isin(ids[:3]) & (df_merged['Date'] <= cut)
+
+    assert history_unchanged(add_calculated_cols(df_merged[(df_merged['Date'] <= cut) & ~late]),
+                             df_merged[~late])
+
+
+def test_history_changed_by_new_country_with_history(df_merged):
+    cut = df_merged['Date'].max() - pd.Timedelta(days=5)
+    new_country = df_merged['Country_id'] == df_merged['Country_id'].iloc[0]
+
+    assert not history_unchanged(add_calculated_cols(df_merged[(df_merged['Date'] <= cut) & ~new_country]),
+                                 df_merged)
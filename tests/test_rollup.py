@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import generate_covid_data
+from wrangling_scripts.wrangle_data import POPDATA_PATH, merge_data, rollup
+
+
+@pytest.fixture(scope='module')
+def df_merged(tmp_path_factory):
+    data_path = str(tmp_path_factory.mktemp('data') / 'covid_19_data.csv')
+    generate_covid_data(data_path, n_regions=300, n_days=60, popdata_path=POPDATA_PATH)
+    return merge_data(data_path, POPDATA_PATH)
+
+
+def test_rollup_carries_missing_days_forward(df_merged):
+    df_country = df_merged[df_merged['Country_id'] == df_merged['Country_id'].iloc[0]].set_index('Date')
+    day, day_before = df_country.index[10], df_country.index[9]
+    continent = df_country['Continent'].iloc[0]
+
+    df_gap = df_merged[~((df_merged['Country_id'] == df_country['Country_id'].iloc[0]) & (df_merged['Date'] == day))]
+
+    full = rollup(df_merged, 'Continent').set_index(['Continent', 'Date']).loc[continent]
+    gap = rollup(df_gap, 'Continent').set_index(['Continent', 'Date']).loc[continent]
+
+    missing = df_country.loc[day, 'Total_deaths'] - df_country.loc[day_before, 'Total_deaths']
+
+    assert gap.loc[day, 'Total_deaths'] == full.loc[day, 'Total_deaths'] - missing
+    assert gap.loc[day, 'Population'] == full.loc[day, 'Population']
+    pd.testing.assert_frame_equal(gap.drop(day), full.drop(day))
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import generate_covid_data
+from wrangling_scripts import snapshot
+from wrangling_scripts.snapshot import write_snapshot, read_snapshot
+from wrangling_scripts.wrangle_data import POPDATA_PATH, merge_data, add_calculated_cols, compact_data
+
+
+def is_memory_mapped(values):
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+@pytest.fixture(scope='module')
+def df_full(tmp_path_factory):
+    data_path = str(tmp_path_factory.mktemp('data') / 'covid_19_data.csv')
+    generate_covid_data(data_path, n_regions=100, n_days=30, popdata_path=POPDATA_PATH)
+    return add_calculated_cols(merge_data(data_path, POPDATA_PATH))
+
+
+@pytest.fixture
+def df_mixed():
+    return pd.DataFrame({'Date': pd.date_range('2020-03-01', periods=4),
+                         'Country': ['Italy', np.nan, 'France', 'Italy'],
+                         'Continent': pd.Categorical(['Europe', 'Europe', 'Europe', 'Asia']),
+                         'Total_deaths': np.array([1, 2, 3, 4], dtype=np.int64),
+                         'Country_id': np.array([5, 6, 7, 5], dtype=np.int32),
+                         'Deaths': [1.0, np.nan, 2.5, 0.0],
+                         'Deaths_s7': np.array([0.5, 1.5, 2.5, 3.5], dtype=np.float32)})
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_round_trip(tmp_path, df_full, compact):
+    df = compact_data(df_full) if compact else df_full
+
+    write_snapshot(df, str(tmp_path), ['stamp', compact])
+
+    pd.testing.assert_frame_equal(read_snapshot(str(tmp_path), ['stamp', compact]), df)
+
+
+def test_round_trip_mixed_dtypes(tmp_path, df_mixed):
+    write_snapshot(df_mixed, str(tmp_path), 'stamp')
+
+    df = read_snapshot(str(tmp_path), 'stamp')
+
+    pd.testing.assert_frame_equal(df, df_mixed)
+    assert is_memory_mapped(df['Deaths'].values) and is_memory_mapped(df['Date'].values)
+
+
+def test_round_trip_without_block_manager(tmp_path, df_mixed, monkeypatch):
+    write_snapshot(df_mixed, str(tmp_path), 'stamp')
+
+    monkeypatch.setattr(snapshot, 'BlockManager', None)
+
+    pd.testing.assert_frame_equal(read_snapshot(str(tmp_path), 'stamp'), df_mixed)
+
+
+def test_other_stamp_is_not_read(tmp_path, df_mixed):
+    write_snapshot(df_mixed, str(tmp_path), 'stamp')
+
+    assert read_snapshot(str(tmp_path), 'other stamp') is None
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    '''
+    This function downsamples a series to n_out points with the Largest-Triangle-Three-Buckets algorithm,
+    which keeps the visual shape of a line chart (peaks and dips survive, flat stretches are thinned out).
+
+    The first and the last point are always kept. The points in between are split into n_out - 2 buckets,
+    and from each bucket the point forming the largest triangle with the point kept from the previous
+    bucket and the average point of the next bucket is kept.
+
+    Args:
+        x (array): x values, increasing (for dates, their int64 nanoseconds)
+        y (array): y values; missing values count as 0 when choosing points
+        n_out (int): number of points to keep
+
+    Returns:
+        indices (array): increasing positions of the kept points
+    '''
+
+    n = len(y)
+
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # relative to the first point, so that dates in nanoseconds keep their precision as floats
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    # bucket i holds the points bounds[i]:bounds[i + 1]
+    bounds = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    bounds[-1] = n - 1
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    a = 0
+
+    for i in range(n_out - 2):
+
+        start, end = bounds[i], bounds[i + 1]
+
+        # average point of the next bucket (the last point for the last bucket)
+        if i + 2 < len(bounds):
+            next_x = x[end:bounds[i + 2]].mean()
+            next_y = y[end:bounds[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+
+        # twice the triangle areas, which is enough to find the largest
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+
+    return indices
@@ -0,0 +1,168 @@
+import os
+import json
+import math
+import tempfile
+
+# the Natural Earth country shapes (1:10m) the geometry is built from, and the directory of the built files
+GEOMETRY_SOURCE = 'data/ne_10m_admin_0_countries.shp'
+GEOMETRY_DIR = 'data/geometry'
+
+# the levels of detail: simplification tolerances in degrees, coarsest first
+GEOMETRY_TOLERANCES = [0.2, 0.05, 0.01]
+
+# roughly the degrees covered by one pixel of a world map at zoom 1 (plotly's geo projection scale);
+# at zoom z a pixel covers PIXEL_DEGREES / z degrees
+PIXEL_DEGREES = 0.3
+
+
+def geometry_path(tolerance, geometry_dir=GEOMETRY_DIR):
+    '''
+    This function returns the path of the GeoJSON file of a level of detail.
+
+    Args:
+        tolerance (float): simplification tolerance in degrees, one of GEOMETRY_TOLERANCES
+        geometry_dir (str) (optional): directory of the built geometry
+
+    Returns:
+        path (str): path of the GeoJSON file
+    '''
+
+    return os.path.join(geometry_dir, 'countries-{}.geojson'.format(tolerance))
+
+
+def geometry_version(path):
+    '''
+    This function identifies the version of a built geometry file by its modification time and size.
+
+    Args:
+        path (str): path of the GeoJSON file
+
+    Returns:
+        version (tuple): (modification time in ns, size in bytes), or None if the file does not exist
+    '''
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _round_coordinates(coordinates, decimals):
+    '''
+    This function rounds the nested coordinate lists of a GeoJSON geometry.
+
+    Args:
+        coordinates (list or tuple): a position, or a list of positions or of lists of them
+        decimals (int): number of decimals to keep
+
+    Returns:
+        coordinates (list): the rounded coordinates
+    '''
+
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return [round(value, decimals) for value in coordinates]
+
+    return [_round_coordinates(part, decimals) for part in coordinates]
+
+
+def build_geometry(source_path=GEOMETRY_SOURCE, geometry_dir=GEOMETRY_DIR, tolerances=GEOMETRY_TOLERANCES):
+    '''
+    This function is the build step of the map geometry. It reads the Natural Earth country shapes and writes
+    one GeoJSON file per level of detail, with the shapes simplified to the tolerance of the level (see
+    'geometry_path'). The features are keyed by ISO code (the 'id' of each feature, Natural Earth's
+    'ADM0_A3') and carry the country name as property 'Country'.
+
+    The coordinates are rounded to one decimal more than the tolerance, which keeps the files small.
+    Every file is written next to its final path first and then moved into place, so the web app never
+    sees a half-written file.
+
+    geopandas is only needed for this build step, not for serving the built files.
+
+    Args:
+        source_path (str) (optional): path to the shapefile
+        geometry_dir (str) (optional): directory to write the GeoJSON files to
+        tolerances (list) (optional): simplification tolerances in degrees
+
+    Returns:
+        paths (list): paths of the written files, one per tolerance
+    '''
+
+    import geopandas as gpd
+    from shapely.geometry import mapping
+
+    gdf = gpd.read_file(source_path)
+
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(epsg=4326)
+
+    gdf = gdf.rename(columns={'ADMIN': 'Country', 'ADM0_A3': 'ISO'})
+    gdf = gdf[gdf['ISO'] != '-99'].drop_duplicates('ISO')
+
+    os.makedirs(geometry_dir, exist_ok=True)
+
+    paths = []
+
+    for tolerance in tolerances:
+
+        decimals = max(0, math.ceil(-math.log10(tolerance))) + 1
+
+        simplified = gdf.geometry.simplify(tolerance, preserve_topology=True)
+
+        features = []
+
+        for iso, country, geometry in zip(gdf['ISO'], gdf['Country'], simplified):
+
+            if geometry is None or geometry.is_empty:
+                continue
+
+            shape = mapping(geometry)
+
+            features.append({'type': 'Feature',
+                             'id': iso,
+                             'properties': {'Country': country},
+                             'geometry': {'type': shape['type'],
+                                          'coordinates': _round_coordinates(shape['coordinates'], decimals)}})
+
+        path = geometry_path(tolerance, geometry_dir)
+
+        # mkstemp creates a file only its owner can read; the web app may run as another user
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=geometry_dir)
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+        paths.append(path)
+
+    return paths
+
+
+def tolerance_for_zoom(zoom, tolerances=GEOMETRY_TOLERANCES):
+    '''
+    This function picks the level of detail for a zoom level: the coarsest tolerance that is still
+    below a pixel (see PIXEL_DEGREES), or the finest one when zoomed in further than that.
+
+    Args:
+        zoom (float): zoom level, plotly's geo projection scale (1 shows the whole world)
+        tolerances (list) (optional): simplification tolerances in degrees, coarsest first
+
+    Returns:
+        tolerance (float): one of tolerances
+    '''
+
+    pixel = PIXEL_DEGREES / max(zoom, 1)
+
+    for tolerance in tolerances:
+        if tolerance <= pixel:
+            return tolerance
+
+    return tolerances[-1]
+
+
+if __name__ == '__main__':
+
+    # build step: writes the simplified geometry for every level of detail
+    for path in build_geometry():
+        print(path)
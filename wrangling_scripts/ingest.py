@@ -0,0 +1,268 @@
+import os
+import time
+import fcntl
+import shutil
+import zipfile
+import logging
+import filecmp
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+from wrangling_scripts.wrangle_data import DATA_PATH, POPDATA_PATH, SNAPSHOT_DIR, merge_data, \
+    add_calculated_cols, append_calculated_cols, store_processed_data, get_processed_data, expand_data
+
+
+KAGGLE_DATASET = 'sudalairajkumar/novel-corona-virus-2019-dataset'
+
+REQUIRED_COLUMNS = ['ObservationDate', 'Country/Region', 'Deaths']
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_from_directory(source_dir, dest_path):
+    '''
+    This function copies the covid-19 data file from a drop directory to dest_path. The directory may
+    contain the data file itself or a zip file containing it (as downloaded from kaggle); the most recently
+    modified of them is used.
+
+    Args:
+        source_dir (str): drop directory
+        dest_path (str): where to copy the data file to
+
+    Returns:
+        found (boolean): False if the directory holds no data file
+    '''
+
+    file_name = os.path.basename(DATA_PATH)
+
+    candidates = [os.path.join(source_dir, f) for f in os.listdir(source_dir)
+                  if f == file_name or f.endswith('.zip')]
+
+    if not candidates:
+        return False
+
+    newest = max(candidates, key=os.path.getmtime)
+
+    if newest.endswith('.zip'):
+
+        with zipfile.ZipFile(newest, 'r') as zip_ref:
+            if file_name not in zip_ref.namelist():
+                return False
+            with zip_ref.open(file_name) as src, open(dest_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+    else:
+        shutil.copyfile(newest, dest_path)
+
+    return True
+
+
+def fetch_from_kaggle(dest_path):
+    '''
+    This function downloads the covid-19 data file from kaggle to dest_path, using the kaggle command line
+    tool (which needs the kaggle api credentials to be set up).
+
+    Args:
+        dest_path (str): where to store the data file
+
+    Returns:
+        found (boolean): False if the download did not contain the data file
+    '''
+
+    with tempfile.TemporaryDirectory() as download_dir:
+
+        subprocess.run(['kaggle', 'datasets', 'download', '-d', KAGGLE_DATASET,
+                        '-f', os.path.basename(DATA_PATH), '-p', download_dir, '--force'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        return fetch_from_directory(download_dir, dest_path)
+
+
+def validate_data(data_path, df_full, df_current=None):
+    '''
+    This function checks a new covid-19 data file and the processed dataset built from it before it
+    replaces the current data. It raises ValueError if
+
+    - any of the columns we use is missing
+    - no rows are left after merging with the population data
+    - there are negative death counts
+    - the data ends before the current data does
+
+    Args:
+        data_path (str): path to the new covid-19 data file
+        df_full (dataframe): processed dataset built from the new file
+        df_current (dataframe) (optional): processed dataset currently in use
+
+    Returns:
+        this function does not return anything
+    '''
+
+    header = pd.read_csv(data_path, nrows=0).columns
+
+    missing = [col for col in REQUIRED_COLUMNS if col not in header]
+
+    if missing:
+        raise ValueError('Missing columns: {}'.format(', '.join(missing)))
+
+    if df_full.empty:
+        raise ValueError('No rows left after merging with the population data')
+
+    if (df_full['Total_deaths'] < 0).any():
+        raise ValueError('Negative death counts')
+
+    if df_current is not None and df_full['Date'].max() < df_current['Date'].max():
+        raise ValueError('Data ends {}, before the current data ({})'.format(
+            df_full['Date'].max().date(), df_current['Date'].max().date()))
+
+
+def history_unchanged(df_current, df_merged):
+    '''
+    This function checks whether new merged data continues the current processed dataset, by comparing
+    the total deaths of every country on the last date of the current dataset. A country that is not in
+    the current dataset but has rows up to that date (for instance one added with its history, or a name
+    that now matches the population data) does not continue it either.
+
+    Args:
+        df_current (dataframe): processed dataset currently in use
+        df_merged (dataframe): merged data from the new covid-19 data file
+
+    Returns:
+        unchanged (boolean): True if the new data agrees with the current dataset on its last date
+    '''
+
+    last_date = df_current['Date'].max()
+
+    history_ids = df_merged['Country_id'].values[df_merged['Date'].values <= last_date.to_datetime64()]
+
+    if not np.isin(history_ids, df_current['Country_id'].values).all():
+        return False
+
+    stored = df_current[df_current['Date'] == last_date].set_index('ISO')['Total_deaths']
+    fresh = df_merged[df_merged['Date'] == last_date].set_index('ISO')['Total_deaths']
+
+    if fresh.index.duplicated().any():
+        return False
+
+    return np.array_equal(stored.values.astype(float), fresh.reindex(stored.index).values.astype(float))
+
+
+def ingest(source, incremental=False):
+    '''
+    This function updates the covid-19 data from a source, which is either 'kaggle' or the path of a
+    drop directory. The sequence is:
+
+    - Fetch the data file to a temporary file next to the current data file
+    - Skip it if it is identical to the current data file
+    - Build the processed dataset from it and validate it. In incremental mode only the dates after the
+      current data are calculated and appended, provided the new file agrees with the current data on its
+      last date; otherwise the full history is calculated.
+    - Store the processed dataset as the snapshot for the new file
+    - Move the new file into place with one atomic os.replace
+
+    Readers either see the old data file or the complete new one, and the snapshot for the new file is
+    ready when it appears, so no request has to build the processed dataset itself. Only one process
+    ingests at a time; if another process holds the ingest lock this call does nothing.
+
+    Args:
+        source (str): 'kaggle' or path of a drop directory
+        incremental (boolean) (optional): True to only calculate the new dates
+
+    Returns:
+        updated (boolean): True if new data was swapped in
+    '''
+
+    data_dir = os.path.dirname(DATA_PATH) or '.'
+
+    with open(os.path.join(data_dir, '.ingest.lock'), 'w') as lock_file:
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.ingest-', suffix='.csv', dir=data_dir)
+        os.close(fd)
+
+        try:
+            if source == 'kaggle':
+                found = fetch_from_kaggle(tmp_path)
+            else:
+                found = fetch_from_directory(source, tmp_path)
+
+            if not found:
+                return False
+
+            if os.path.exists(DATA_PATH) and filecmp.cmp(tmp_path, DATA_PATH, shallow=False):
+                return False
+
+            df_merged = merge_data(tmp_path, POPDATA_PATH)
+
+            df_current = expand_data(get_processed_data()) if os.path.exists(DATA_PATH) else None
+
+            if incremental and df_current is not None and history_unchanged(df_current, df_merged):
+                df_full = append_calculated_cols(df_current, df_merged)
+            else:
+                df_full = add_calculated_cols(df_merged)
+
+            validate_data(tmp_path, df_full, df_current)
+
+            # mkstemp creates the file readable by its owner only; the data file keeps the mode of the one
+            # it replaces, so that readers running as other users can still open it
+            if os.path.exists(DATA_PATH):
+                shutil.copymode(DATA_PATH, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o644)
+
+            store_processed_data(df_full, tmp_path, POPDATA_PATH, SNAPSHOT_DIR)
+
+            os.replace(tmp_path, DATA_PATH)
+
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # swapping the new dataset into this process right away
+    get_processed_data()
+
+    logger.info('Ingested new data from %s', source)
+
+    return True
+
+
+def start_ingest_worker(source, interval=3600, incremental=False, single=False):
+    '''
+    This function starts a background thread that calls ingest(source, incremental) every interval seconds.
+    Errors are logged, and the current data stays in use until a later run succeeds.
+
+    With single=True, several processes (such as the gunicorn workers) can each start the thread while only
+    one of them ingests: the thread first takes a lock file next to the data file, and holds it for as long
+    as its process lives. The threads of the other processes wait for the lock, so one of them takes over
+    when that process goes away.
+
+    Args:
+        source (str): 'kaggle' or path of a drop directory
+        interval (int) (optional): seconds between runs
+        incremental (boolean) (optional): True to only calculate the new dates on each run
+        single (boolean) (optional): True to ingest in one process only
+
+    Returns:
+        worker (Thread): the started daemon thread
+    '''
+
+    def run():
+        if single:
+            lock_file = open(os.path.join(os.path.dirname(DATA_PATH) or '.', '.ingest-worker.lock'), 'w')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        while True:
+            try:
+                ingest(source, incremental)
+            except Exception:
+                logger.exception('Ingesting data from %s failed', source)
+            time.sleep(interval)
+
+    worker = threading.Thread(target=run, name='ingest-worker', daemon=True)
+    worker.start()
+
+    return worker
@@ -0,0 +1,203 @@
+import os
+import time
+import bisect
+import threading
+import functools
+import contextlib
+
+
+# instrumentation is off unless PANDEMIC_METRICS=1. When it is off, 'timed' returns the function
+# unchanged and 'timer' returns a shared do-nothing context, so the hot path pays nothing.
+ENABLED = os.environ.get('PANDEMIC_METRICS') == '1'
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def _reset_lock():
+    # a forked child gets a new lock, since the one it inherits may be held by a thread of its parent
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+_null_timer = contextlib.nullcontext()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    '''
+    This function records one duration in a histogram.
+
+    Args:
+        name (str): metric name
+        seconds (float): the duration
+        labels: label names and values, for instance stage='merge_data'
+
+    Returns:
+        this function does not return anything
+    '''
+
+    key = _key(name, labels)
+    bucket = bisect.bisect_left(BUCKETS, seconds)
+
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+        if bucket < len(BUCKETS):
+            histogram['buckets'][bucket] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+def count(name, amount=1, **labels):
+    '''
+    This function increases a counter. It does nothing when instrumentation is off.
+
+    Args:
+        name (str): metric name
+        amount (int) (optional): increase
+        labels: label names and values, for instance cache='page', result='hit'
+
+    Returns:
+        this function does not return anything
+    '''
+
+    if not ENABLED:
+        return
+
+    key = _key(name, labels)
+
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+class _Timer:
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timer(name, **labels):
+    '''
+    This function returns a context manager recording how long its block takes in a histogram.
+
+    Args:
+        name (str): metric name
+        labels: label names and values, for instance figure='1'
+
+    Returns:
+        context manager
+    '''
+
+    if not ENABLED:
+        return _null_timer
+
+    return _Timer(name, labels)
+
+
+def timed(stage):
+    '''
+    This function is a decorator recording how long each call takes, in the histogram
+    'pandemic_stage_seconds' with the label stage.
+
+    Args:
+        stage (str): name of the stage, for instance 'merge_data'
+
+    Returns:
+        decorator
+    '''
+
+    def decorator(func):
+
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer('pandemic_stage_seconds', {'stage': stage}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+def render_prometheus():
+    '''
+    This function renders all metrics in the Prometheus text format. Besides the histograms and counters,
+    a 'pandemic_cache_hit_ratio' gauge is given for every cache counted in 'pandemic_cache_requests_total'.
+
+    The metrics are kept per process, so with several gunicorn workers each scrape shows one worker.
+
+    Args:
+        None
+
+    Returns:
+        text (str): metrics in the Prometheus text format
+    '''
+
+    lines = []
+
+    with _lock:
+        histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in _histograms.items()}
+        counters = dict(_counters)
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append('# TYPE {} histogram'.format(name))
+        for (key_name, labels), histogram in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, histogram['buckets']):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram['count']))
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append('# TYPE {} counter'.format(name))
+        for (key_name, labels), value in sorted(counters.items()):
+            if key_name == name:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+    # hit ratio per cache
+    requests = {}
+    for (name, labels), value in counters.items():
+        if name == 'pandemic_cache_requests_total':
+            labels = dict(labels)
+            hits, total = requests.get(labels.get('cache'), (0, 0))
+            requests[labels.get('cache')] = (hits + (value if labels.get('result') == 'hit' else 0), total + value)
+
+    if requests:
+        lines.append('# TYPE pandemic_cache_hit_ratio gauge')
+        for cache, (hits, total) in sorted(requests.items()):
+            lines.append('pandemic_cache_hit_ratio{{cache="{}"}} {}'.format(cache, hits / total))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,105 @@
+import os
+import json
+import base64
+import numpy as np
+import pandas as pd
+import plotly
+
+
+# how the figures are sent to the browser (PANDEMIC_PAYLOAD): 'json' sends every array as a JSON list,
+# 'binary' sends the numeric and date arrays as base64 typed arrays (see 'encode_figure')
+PAYLOAD = os.environ.get('PANDEMIC_PAYLOAD', 'json')
+
+# the trace attributes that are sent as typed arrays when they hold numbers or dates
+ARRAY_KEYS = ['x', 'y', 'z', 'lat', 'lon']
+
+DAY_NS = 86400 * 10**9
+
+
+def encode_array(values):
+    '''
+    This function encodes an array of numbers or dates as a base64 typed array:
+
+    - integers fitting in 32 bits as 'i4', other numbers as 'f8' (missing values are NaN)
+    - dates at midnight as 'date': 'i4' days since 1970-01-01
+
+    All in little endian byte order, as read by javascript typed arrays. Arrays of anything else
+    (for instance country names) are not encoded.
+
+    Args:
+        values (list or array): the array
+
+    Returns:
+        encoded (dict): 'dtype' and 'bdata' (base64), or None if the array can not be encoded
+    '''
+
+    if len(values) == 0:
+        return None
+
+    first = values[0]
+
+    if isinstance(first, (pd.Timestamp, np.datetime64)):
+        ns = pd.DatetimeIndex(values).asi8
+        if (ns % DAY_NS).any():
+            return None
+        dtype, array = 'date', (ns // DAY_NS).astype('<i4')
+
+    else:
+        array = np.asarray(values)
+
+        if array.dtype.kind in 'iu' and array.size and -2**31 <= array.min() and array.max() < 2**31:
+            dtype, array = 'i4', array.astype('<i4')
+        elif array.dtype.kind in 'iuf':
+            dtype, array = 'f8', array.astype('<f8')
+        else:
+            return None
+
+    return {'dtype': dtype, 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def encode_figure(figure):
+    '''
+    This function turns a figure into its compact form: the numeric and date arrays of the traces
+    (see ARRAY_KEYS) become base64 typed arrays, which the index page decodes before plotting.
+
+    Args:
+        figure (dict): plotly figure, with 'data' (list of traces) and 'layout'
+
+    Returns:
+        figure (dict): the figure with plain dict traces
+    '''
+
+    data = []
+
+    for trace in figure['data']:
+
+        trace = trace.to_plotly_json() if hasattr(trace, 'to_plotly_json') else dict(trace)
+
+        for key in ARRAY_KEYS:
+            values = trace.get(key)
+            if isinstance(values, (list, tuple, np.ndarray)):
+                encoded = encode_array(values)
+                if encoded:
+                    trace[key] = encoded
+
+        data.append(trace)
+
+    return dict(figure, data=data)
+
+
+def dumps_figure(figure, payload=PAYLOAD):
+    '''
+    This function serializes a figure for the browser.
+
+    Args:
+        figure (dict): plotly figure
+        payload (str) (optional): 'json' or 'binary' (see PAYLOAD)
+
+    Returns:
+        figureJSON (str): the figure as JSON
+    '''
+
+    if payload == 'binary':
+        figure = encode_figure(figure)
+
+    return json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)
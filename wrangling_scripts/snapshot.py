@@ -0,0 +1,273 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import warnings
+import contextlib
+import numpy as np
+import pandas as pd
+
+try:
+    from pandas.core.internals import BlockManager, make_block
+except ImportError:
+    BlockManager = make_block = None
+
+
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.build.lock'
+
+# version of the snapshot file layout; snapshots written in another layout are not read
+FORMAT_VERSION = 2
+
+
+def _stamp_json(stamp):
+    '''
+    This function normalizes a version stamp to its json form (tuples become lists), so that a stamp
+    can be compared with the one stored in a manifest.
+
+    Args:
+        stamp: json serializable version stamp
+
+    Returns:
+        stamp in json form
+    '''
+
+    return json.loads(json.dumps(stamp))
+
+
+def write_snapshot(df, snapshot_dir, stamp):
+    '''
+    This function writes a dataframe to a columnar snapshot on disk, and a manifest describing the columns,
+    stamped with the version of the data the dataframe was built from.
+
+    - Numeric columns are stored together per dtype, as one 2-D .npy file with a row per column, which is
+      how pandas keeps them in memory (see 'read_snapshot')
+    - Dates are stored the same way, as int64 nanoseconds
+    - String columns are stored as int32 codes (-1 for missing), with the distinct strings kept in the manifest
+    - Category columns are stored as their codes, with the categories kept in the manifest
+
+    The files are written to a new directory first, and the manifest is replaced last in one atomic step,
+    so readers see either the old or the new snapshot and never a half-written one. Directories of older
+    snapshots are removed afterwards. The snapshot is readable by other users, like the data files.
+
+    Args:
+        df (dataframe): dataframe to store
+        snapshot_dir (str): directory holding the snapshot
+        stamp: json serializable version stamp
+
+    Returns:
+        this function does not return anything
+    '''
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    stamp = _stamp_json(stamp)
+    name = 'snapshot-' + hashlib.sha1(json.dumps(stamp).encode()).hexdigest()[:16]
+
+    # mkdtemp and mkstemp create a directory and files only their owner can read
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=snapshot_dir)
+    os.chmod(tmp_dir, 0o755)
+
+    # the numeric and date columns by dtype, with their positions
+    groups = {}
+    coded = []
+
+    for i, col in enumerate(df.columns):
+
+        values = df[col]
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            file_name = 'column-{}.npy'.format(i)
+            coded.append({'position': i, 'kind': 'category', 'file': file_name,
+                          'categories': [str(v) for v in values.cat.categories]})
+            np.save(os.path.join(tmp_dir, file_name), np.ascontiguousarray(values.cat.codes.values))
+
+        elif values.dtype == object:
+            file_name = 'column-{}.npy'.format(i)
+            codes, uniques = pd.factorize(values)
+            coded.append({'position': i, 'kind': 'string', 'file': file_name,
+                          'categories': [str(v) for v in uniques]})
+            np.save(os.path.join(tmp_dir, file_name), codes.astype(np.int32))
+
+        elif np.issubdtype(values.dtype, np.datetime64):
+            groups.setdefault(('datetime', 'i8'), []).append((i, values.values.view('i8')))
+
+        else:
+            groups.setdefault(('numeric', values.dtype.str), []).append((i, values.values))
+
+    blocks = []
+
+    for j, ((kind, dtype), group) in enumerate(groups.items()):
+        file_name = 'block-{}.npy'.format(j)
+        np.save(os.path.join(tmp_dir, file_name), np.stack([values for _, values in group]))
+        blocks.append({'kind': kind, 'file': file_name, 'positions': [i for i, _ in group]})
+
+    target_dir = os.path.join(snapshot_dir, name)
+
+    if os.path.isdir(target_dir):
+        # the same data version has been written already (for instance by another worker)
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, target_dir)
+
+    manifest = {'format': FORMAT_VERSION, 'stamp': stamp, 'directory': name, 'rows': len(df),
+                'columns': [str(col) for col in df.columns], 'blocks': blocks, 'coded': coded}
+
+    fd, tmp_manifest = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=snapshot_dir)
+    os.chmod(tmp_manifest, 0o644)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, os.path.join(snapshot_dir, MANIFEST_NAME))
+
+    # removing older snapshots. Files still memory-mapped by a reader stay readable until it lets go of them.
+    for entry in os.listdir(snapshot_dir):
+        if entry.startswith('snapshot-') and entry != name:
+            shutil.rmtree(os.path.join(snapshot_dir, entry), ignore_errors=True)
+
+
+def read_snapshot(snapshot_dir, stamp):
+    '''
+    This function loads the dataframe stored in a columnar snapshot, provided the snapshot was built
+    from the data version given by stamp. Loading involves no parsing.
+
+    The numeric and date columns stay memory-mapped: each file of columns of one dtype is opened as a
+    memory map and becomes one block of the dataframe as it is, without being copied. Processes loading
+    the same snapshot (such as the gunicorn workers) share those pages through the operating system,
+    and the dataframe can not be modified in place. The string and category columns are rebuilt in memory
+    from their codes.
+
+    Args:
+        snapshot_dir (str): directory holding the snapshot
+        stamp: json serializable version stamp the snapshot must match
+
+    Returns:
+        df (dataframe): the stored dataframe, or None if there is no current snapshot
+    '''
+
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('format') != FORMAT_VERSION or manifest['stamp'] != _stamp_json(stamp):
+        return None
+
+    directory = os.path.join(snapshot_dir, manifest['directory'])
+
+    blocks = []
+    strings = []
+
+    try:
+        for block in manifest['blocks']:
+
+            # a plain array on the memory map, so the columns are not of the np.memmap subclass
+            values = np.load(os.path.join(directory, block['file']), mmap_mode='r').view(np.ndarray)
+
+            if block['kind'] == 'datetime':
+                values = values.view('datetime64[ns]')
+
+            blocks.append((values, block['positions']))
+
+        for column in manifest['coded']:
+
+            codes = np.load(os.path.join(directory, column['file']), mmap_mode='r')
+
+            if column['kind'] == 'category':
+                blocks.append((pd.Categorical.from_codes(codes, categories=column['categories']),
+                               [column['position']]))
+            else:
+                # missing values have code -1, which picks the trailing NaN
+                strings.append((column['position'], np.array(column['categories'] + [np.nan], dtype=object)[codes]))
+
+    except OSError:
+        # the snapshot was replaced while we were reading it
+        return None
+
+    if strings:
+        blocks.append((np.stack([values for _, values in strings]), [position for position, _ in strings]))
+
+    return _frame_from_blocks(blocks, manifest['columns'], manifest['rows'])
+
+
+def _frame_from_blocks(blocks, columns, rows):
+    '''
+    This function puts a dataframe together from blocks of columns: 2-D arrays holding one column per row,
+    and 1-D extension arrays (such as a Categorical) holding a single column.
+
+    The blocks are handed to pandas' internal BlockManager as they are, one block per dtype, the way
+    pandas consolidates a dataframe anyway, so it never copies them and memory-mapped arrays stay
+    memory-mapped. The BlockManager is not part of the public API of pandas; this was checked against
+    pandas 1.5.3 and 2.2.3. Where it is missing or does not accept the blocks, the dataframe is built
+    from the columns with pd.DataFrame instead, which gives the same dataframe but copies the columns
+    into memory.
+
+    Args:
+        blocks (list): (values, positions) of every block, positions being the columns it holds
+        columns (list): the column names
+        rows (int): the number of rows
+
+    Returns:
+        df (dataframe): dataframe with a RangeIndex
+    '''
+
+    axes = [pd.Index(columns), pd.RangeIndex(rows)]
+
+    if BlockManager is not None:
+        try:
+            with warnings.catch_warnings():
+                # pandas 2 warns that passing a BlockManager to DataFrame is deprecated
+                warnings.simplefilter('ignore', DeprecationWarning)
+                manager = BlockManager([make_block(values, placement=positions) for values, positions in blocks],
+                                       axes)
+                return pd.DataFrame(manager)
+        except (TypeError, ValueError, AssertionError):
+            pass
+
+    data = {}
+
+    for values, positions in blocks:
+        if values.ndim == 1:
+            data[positions[0]] = values
+        else:
+            data.update(zip(positions, values))
+
+    return pd.DataFrame({columns[i]: data[i] for i in range(len(columns))}, index=axes[1], columns=axes[0])
+
+
+@contextlib.contextmanager
+def build_lock(snapshot_dir):
+    '''
+    This context manager holds an exclusive lock on a lock file in the snapshot directory, so that processes
+    sharing the directory (such as the gunicorn workers) build a snapshot one at a time: whoever gets the
+    lock first builds and writes the snapshot, and the others find it when they get the lock.
+
+    Where the lock file can not be created (for instance on a read-only file system) nothing is locked.
+
+    Args:
+        snapshot_dir (str): directory holding the snapshot
+
+    Returns:
+        this context manager does not return anything
+    '''
+
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        lock_file = open(os.path.join(snapshot_dir, LOCK_NAME), 'w')
+    except OSError:
+        yield
+        return
+
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+if __name__ == '__main__':
+
+    # ingest step: building the processed dataset writes the snapshot for the current data version
+    from wrangling_scripts.wrangle_data import get_processed_data
+
+    get_processed_data()
@@ -1,7 +1,125 @@
+import os
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
 import pandas as pd
 import numpy as np
 import datetime as dt
 import plotly.graph_objs as go
+from wrangling_scripts.snapshot import read_snapshot, write_snapshot, build_lock
+from wrangling_scripts.instrumentation import timed, timer, count
+from wrangling_scripts.downsample import lttb
+from wrangling_scripts.payload import PAYLOAD
+
+
+POPDATA_PATH = 'data/population_2020_for_johnhopkins_data.csv'
+DATA_PATH = 'data/covid_19_data.csv'
+SNAPSHOT_DIR = 'data/processed'
+
+# optional population per province/state (see 'get_region_popdata'); it is not shipped with the data
+REGION_POPDATA_PATH = 'data/region_population.csv'
+
+# number of rows of the covid-19 data file read at a time
+COVID_DATA_CHUNKSIZE = 100000
+
+# country names in the covid-19 data that differ from the ones used in the population dataset
+COUNTRY_ALIASES = {'UK': 'United Kingdom',
+                   'US': 'United States',
+                   'Mainland China': 'China',
+                   'Czech Republic': 'Czechia',
+                   'Burma': 'Myanmar',
+                   "('St. Martin',)": "St. Martin",
+                   "occupied Palestinian territory": "Palestine",
+                   "State of Palestine": "Palestine",
+                   "Ivory Coast": "Cote d'Ivoire",
+                   "Gambia, The": "Gambia",
+                   "The Gambia": "Gambia",
+                   "The Bahamas": "Bahamas",
+                   "Bahamas, The": "Bahamas",
+                   "Republic of Ireland": "Ireland",
+                   "Republic of the Congo": "Congo (Brazzaville)",
+                   " Azerbaijan": "Azerbaijan"
+                   }
+
+# version of the processed dataset layout. Increase it whenever the columns produced by
+# 'merge_data' or 'add_calculated_cols' change, so that older snapshots are not used.
+PROCESSED_VERSION = 4
+
+# valid values for the continent filter and for the variable to rank countries on
+CONTINENTS = ['America', 'Europe', 'Asia', 'Africa', 'Oceania']
+
+VAR_LIST = ['Population', 'Pop_km2', 'Urban_Population_ratio', 'Median_age', 'Total_deaths',
+            'Total_deaths_per_100k', 'Deaths', 'Deaths_per_100k', 'Deaths_s7', 'Deaths_per_100k_s7',
+            'Deaths_week', 'Deaths_lastweek', 'Infection_rate']
+
+# compact mode keeps the processed dataset with categories and small number types, see 'compact_data'
+COMPACT = os.environ.get('PANDEMIC_COMPACT') == '1'
+
+# maximum number of points per trace in the time series figures (PANDEMIC_POINT_BUDGET, off by default).
+# Longer traces are downsampled with LTTB; a zoomed-in date window is always sent at full resolution.
+POINT_BUDGET = int(os.environ.get('PANDEMIC_POINT_BUDGET', 0)) or None
+
+# number of workers building the figures in parallel (PANDEMIC_FIGURE_WORKERS, 0 builds them one by one),
+# and the kind of pool (PANDEMIC_FIGURE_POOL): 'thread', or 'process' for processes forked from this one,
+# which share the loaded dataset with it
+FIGURE_WORKERS = int(os.environ.get('PANDEMIC_FIGURE_WORKERS', 0))
+FIGURE_POOL = os.environ.get('PANDEMIC_FIGURE_POOL', 'thread')
+
+# first date shown in the time series figures
+TIME_SERIES_START = '2020-03-09'
+
+# the levels of the hierarchical data (see 'build_hierarchy'): the column that identifies a series
+# for the calculated columns, and the column that names it
+LEVEL_KEYS = {'region': 'Region', 'country': 'Country_id', 'continent': 'Continent'}
+LEVEL_NAMES = {'region': 'Region', 'country': 'Country', 'continent': 'Continent'}
+
+# the date selections of the processed dataset kept per data version, by name (see 'dates_choice')
+DATE_SELECTIONS = {'latest': dict(all_dates=False, weekly=False),
+                   'daily': dict(all_dates=True, weekly=False),
+                   'weekly': dict(all_dates=False, weekly=True)}
+
+# the rolling windows of the processed dataset in days (PANDEMIC_ROLLING_WINDOWS, comma separated), and
+# the columns calculated for each window (see '_add_rolling_cols')
+ROLLING_WINDOWS = [int(w) for w in os.environ.get('PANDEMIC_ROLLING_WINDOWS', '7,14,28').split(',')]
+ROLLING_COLS = [col.format(w) for w in ROLLING_WINDOWS
+                for col in ['Deaths_sum{}', 'Deaths_s{}', 'Deaths_per_100k_s{}', 'Deaths_growth{}']]
+
+# columns that are left out in compact mode, since they can be recalculated from 'Population'
+PER_100K_COLS = {'Total_deaths_per_100k': 'Total_deaths',
+                 'Deaths_per_100k': 'Deaths',
+                 'Deaths_week_per_100k': 'Deaths_week'}
+PER_100K_COLS.update({'Deaths_per_100k_s{}'.format(w): 'Deaths_s{}'.format(w) for w in ROLLING_WINDOWS})
+
+logger = logging.getLogger(__name__)
+
+# the processed dataset (merged data with calculated columns) is built once per data version
+# and shared by all figures. 'derived' holds artifacts built from it (date selections etc.),
+# which are thrown away together with the dataset when the source files change.
+_processed = {'key': None, 'df_full': None, 'derived': {}, 'derived_locks': {}}
+_processed_lock = threading.RLock()
+
+
+def _reset_locks():
+    '''
+    This function gives a forked child process (such as a worker of the process pool of 'return_figures')
+    new locks. The child inherits the locks in whatever state the threads of its parent held them at the
+    time of the fork, and those threads do not exist in the child to release them.
+
+    Args:
+        None
+
+    Returns:
+        this function does not return anything
+    '''
+
+    global _processed_lock
+
+    _processed_lock = threading.RLock()
+    _processed['derived_locks'] = {}
+
+
+os.register_at_fork(after_in_child=_reset_locks)
 
 
 def get_popdata(popdata_path):
@@ -39,320 +157,1445 @@ def get_popdata(popdata_path):
 
     return df_pop
 
-def get_covid_data(data_path):
+def get_country_dimension(popdata_path=POPDATA_PATH):
+    '''
+    This function builds the canonical country dimension from the population data. Every country gets
+    an integer 'Country_id' (its row in the population data), and every name the covid-19 data may use
+    for it (the name in the population data, or one of COUNTRY_ALIASES) is mapped to that id.
+
+    Args:
+        popdata_path (str) (optional): path to the population data file
+
+    Returns:
+        df_countries (dataframe): population data, indexed by Country_id
+        country_ids (series): Country_id, indexed by every known country name
+    '''
+
+    df_countries = get_popdata(popdata_path)
+    df_countries.index = pd.RangeIndex(len(df_countries), name='Country_id')
+
+    country_ids = pd.Series(df_countries.index.values, index=df_countries['Country'].values)
+
+    aliases = pd.Series(COUNTRY_ALIASES)
+    aliases = aliases[aliases.isin(country_ids.index)]
+
+    country_ids = pd.concat([country_ids, pd.Series(country_ids[aliases.values].values, index=aliases.index)])
+
+    return df_countries, country_ids
+
+
+def get_covid_data(data_path, chunksize=COVID_DATA_CHUNKSIZE, regions=False, country_ids=None):
     '''
     This function reads the covid-19 data from csv file into a pandas DataFrame, cleans up the
-    column names and updates some of the country names to match the ones used in the population dataset.
+    column names and identifies the countries by their id in the country dimension (see
+    'get_country_dimension'), which takes care of the names that differ from the ones used in the
+    population dataset.
+
+    The file is read in chunks of chunksize rows, and only the columns we use are parsed: the country as a
+    category, the date with its known format and the deaths as numbers. Each chunk is summed up to country
+    and date as it arrives, so memory use depends on the number of countries and dates, not on the size of
+    the file. The country names are looked up on the list of distinct names of each chunk, not on every row.
+
+    Rows of countries that are not in the country dimension are left out, and their names are logged
+    as a warning (see 'unmatched_countries' for a full report).
 
     The data contains the following on country-level:
-    - Country name
+    - Country id
     - Date (Daily. The start date is not the same for all countries; it ranges from January to March 2020)
     - Deaths (total number for respective country at respective date)
 
+    With regions=True the data is kept on the level of 'Province/State' instead, in the extra column
+    'Province' ('' where the data is given for the country as a whole).
+
     Args:
         data_path (str): path to covid-19 data file
+        chunksize (int) (optional): number of rows read at a time
+        regions (boolean) (optional): True to keep the data per province/state
+        country_ids (series) (optional): country ids by name, from 'get_country_dimension'
+                                         (by default built from the population data at POPDATA_PATH)
+
+    Returns:
+        df_covid (dataframe): total deaths per country id (and province) and date,
+                              sorted on Country_id (then Province), then Date
+    '''
+
+    if country_ids is None:
+        country_ids = get_country_dimension()[1]
+
+    usecols = ['ObservationDate', 'Country/Region', 'Deaths']
+    dtype = {'Country/Region': 'category', 'Deaths': np.float64}
+
+    if regions:
+        usecols.append('Province/State')
+        dtype['Province/State'] = 'category'
+
+    keys = ['Country_id', 'Province'] if regions else ['Country_id']
+
+    reader = pd.read_csv(data_path, usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+    chunks = []
+    unmatched = {}
+
+    for chunk in reader:
+
+        # the id of every distinct country name in the chunk (-1 for names that are not known)
+        country = chunk['Country/Region'].cat
+        name_ids = country_ids.reindex(country.categories).fillna(-1).values.astype(np.int32)
+        ids = np.where(country.codes >= 0, name_ids[np.maximum(country.codes, 0)], -1)
+
+        # rows of unknown countries are counted per name for the warning, and left out
+        known = ids >= 0
+
+        if not known.all():
+            for name, rows in pd.Series(country.codes[~known]).value_counts().items():
+                name = country.categories[name] if name >= 0 else '(missing)'
+                unmatched[name] = unmatched.get(name, 0) + rows
+            chunk = chunk[known]
+            ids = ids[known]
+
+        df = pd.DataFrame({'Country_id': ids,
+                           'Date': pd.to_datetime(chunk['ObservationDate'], format='%m/%d/%Y').values,
+                           'Total_deaths': chunk['Deaths'].values})
+
+        if regions:
+            province = chunk['Province/State'].cat
+            df['Province'] = province.add_categories([''] if '' not in province.categories else []).fillna('').values
+
+        # whereever data is on regional level, groupby ensures we get the data summed up to country level
+        # (or, with regions=True, to province level)
+        df = df.groupby(keys + ['Date'], observed=True)['Total_deaths'].sum().reset_index()
+        if regions:
+            df['Province'] = df['Province'].astype(str)
+
+        chunks.append(df)
+
+    if unmatched:
+        logger.warning('Left out %d rows of countries not in the population data: %s', sum(unmatched.values()),
+                       ', '.join('{} ({})'.format(name, rows) for name, rows in sorted(unmatched.items())))
+
+    # sort on Country_id, then Date. A country and date may appear in more than one chunk, so the
+    # chunk sums get summed up once more
+    df_covid = pd.concat(chunks).groupby(keys + ['Date'])['Total_deaths'].sum().reset_index()
+
+    df_covid['Total_deaths'] = df_covid['Total_deaths'].round().astype(np.int64)
+
+    return df_covid
+
+
+def unmatched_countries(data_path=DATA_PATH, popdata_path=POPDATA_PATH):
+    '''
+    This function reports the country names of the covid-19 data that are not in the country dimension
+    (see 'get_country_dimension'), and so are left out of the processed dataset. A name showing up here
+    usually needs an entry in COUNTRY_ALIASES.
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+
+    Returns:
+        report (dataframe): number of rows and the last date per unmatched name, most rows first
+    '''
+
+    country_ids = get_country_dimension(popdata_path)[1]
+
+    df = pd.read_csv(data_path, usecols=['ObservationDate', 'Country/Region'], dtype={'Country/Region': 'category'})
+
+    df = df[~df['Country/Region'].isin(country_ids.index)]
+
+    report = df.groupby('Country/Region', observed=True)['ObservationDate'].agg(
+        Rows='size', Last_date=lambda dates: pd.to_datetime(dates, format='%m/%d/%Y').max())
+
+    return report.sort_values('Rows', ascending=False)
+
+
+@timed('merge_data')
+def merge_data(data_path=DATA_PATH, popdata_path=POPDATA_PATH):
+    '''
+    This function get the population data and the covid-19 data and merges it to one dataframe
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+
+    Returns:
+        df_merged (dataframe): merged data
+    '''
+
+    df_countries, country_ids = get_country_dimension(popdata_path)
+
+    df_covid = get_covid_data(data_path, country_ids=country_ids)
+
+    return _join_popdata(df_covid, df_countries)
+
+
+def _join_popdata(df_covid, df_countries):
+    '''
+    This function joins the population data to covid-19 data on the country id. Since the id is the row
+    of the country in the country dimension, the join takes the rows of the ids directly. Countries
+    without a population are left out. Columns of the covid-19 data besides Country_id, Date and
+    Total_deaths (such as 'Province') are kept after 'Country'.
+
+    Args:
+        df_covid (dataframe): covid-19 data with a 'Country_id' column
+        df_countries (dataframe): country dimension, from 'get_country_dimension'
+
+    Returns:
+        df_merged (dataframe): merged data
+    '''
+
+    ids = df_covid['Country_id'].values
+
+    df_merged = df_countries.iloc[ids].reset_index()
+    for col in df_covid.columns.drop('Country_id'):
+        df_merged[col] = df_covid[col].values
+
+    df_merged = df_merged[df_merged['Population'].notna().values]
+
+    for col in ['Population', 'Pop_km2', 'Median_age']:
+        df_merged[col] = df_merged[col].astype(np.float64)
+    df_merged['Country_id'] = df_merged['Country_id'].astype(np.int32)
+
+    extra = [col for col in df_covid.columns if col not in ['Country_id', 'Date', 'Total_deaths']]
+
+    df_merged = df_merged[['Date', 'Continent', 'Country'] + extra + ['ISO', 'Country_id', 'Population', 'Urban_Population_ratio', 'Pop_km2', 'Median_age', 'Total_deaths']]
+
+    return df_merged.reset_index(drop=True)
+
+
+def get_region_popdata(region_popdata_path):
+    '''
+    This function reads the population per province/state, the dimension table for the region level of
+    the hierarchical data. The file is optional; it is a semicolon separated file (like the population
+    data) with the columns Country, Province/State and Population, using the country names of the
+    population data.
+
+    Args:
+        region_popdata_path (str): path to the region population file
+
+    Returns:
+        df_region_pop (dataframe): Population indexed by Country and Province (empty if there is no file)
+    '''
+
+    index = pd.MultiIndex.from_arrays([[], []], names=['Country', 'Province'])
+
+    if not os.path.exists(region_popdata_path):
+        return pd.DataFrame({'Population': pd.Series([], index=index, dtype=np.float64)})
+
+    df_region_pop = pd.read_csv(region_popdata_path, delimiter=';')
+    df_region_pop.columns = ['Country', 'Province', 'Population']
+
+    return df_region_pop.set_index(['Country', 'Province'])[['Population']].astype(np.float64)
+
+
+def merge_region_data(data_path=DATA_PATH, popdata_path=POPDATA_PATH, region_popdata_path=REGION_POPDATA_PATH):
+    '''
+    This function merges the covid-19 data per province/state with the population data. Besides the
+    merged columns of 'merge_data' it has the columns 'Province' ('' for data given for the whole country)
+    and 'Region', which names the series: the country name, or 'Province, Country'.
+
+    Rows for a whole country get the country's population. Rows for a province get its population from
+    the region population file, looked up on (Country, Province); it is missing where the file does not
+    have the province. The other population columns are those of the country.
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+        region_popdata_path (str) (optional): path to the region population file
+
+    Returns:
+        df_region (dataframe): merged data per province/state
+    '''
+
+    df_countries, country_ids = get_country_dimension(popdata_path)
+
+    df_covid = get_covid_data(data_path, regions=True, country_ids=country_ids)
+
+    df_region = _join_popdata(df_covid, df_countries)
+
+    province = df_region['Province'].values
+    whole_country = province == ''
+
+    df_region.insert(4, 'Region', np.where(whole_country, df_region['Country'].values,
+                                           province.astype(object) + ', ' + df_region['Country'].values))
+
+    region_pop = get_region_popdata(region_popdata_path)['Population']
+    lookup = region_pop.reindex(pd.MultiIndex.from_arrays([df_region['Country'], df_region['Province']])).values
+
+    df_region['Population'] = np.where(whole_country, df_region['Population'].values, lookup)
+
+    return df_region
+
+
+def rollup(df_merged, by):
+    '''
+    This function sums up merged data (see 'merge_data') per group and date, for instance the countries of
+    each continent. 'Total_deaths' and 'Population' are summed up, 'Median_age' and 'Urban_Population_ratio'
+    are averaged weighted by population, and 'Pop_km2' is the total population over the total area.
+    The other columns of df_merged are left out.
+
+    A country that has no row on a date after its first one (a day it did not report, or the days after
+    its data ends) still counts on that date with its last reported numbers, so the sums do not dip when
+    a country misses a day.
+
+    Args:
+        df_merged (dataframe): merged data
+        by (str): the column to group by, for instance 'Continent'
+
+    Returns:
+        df_rollup (dataframe): merged data per group and date
+    '''
+
+    # one row per country and day, from the country's first date to the last date of the data
+    order = np.lexsort((df_merged['Date'].values, df_merged['Country_id'].values))
+    days = df_merged['Date'].values[order].astype('datetime64[D]').astype(np.int64)
+
+    country = np.cumsum(_segment_starts(df_merged['Country_id'].values[order])) - 1
+    first_day = days[np.flatnonzero(np.diff(country, prepend=-1))]
+    lengths = days.max() - first_day + 1
+
+    grid_start = np.append(0, np.cumsum(lengths))
+    grid_country = np.repeat(np.arange(len(lengths)), lengths)
+    grid_days = first_day[grid_country] + np.arange(grid_start[-1]) - grid_start[grid_country]
+
+    # every day takes the country's last row up to that day; the first day of each country has a row
+    source = np.full(grid_start[-1], -1)
+    source[grid_start[country] + days - first_day[country]] = np.arange(len(order))
+    rows = order[np.maximum.accumulate(source)]
+
+    population = df_merged['Population'].values[rows]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area = np.where(df_merged['Pop_km2'].values[rows] > 0, population / df_merged['Pop_km2'].values[rows], np.nan)
+
+    df = pd.DataFrame({by: np.asarray(df_merged[by])[rows],
+                       'Date': grid_days.astype('datetime64[D]').astype('datetime64[ns]'),
+                       'Total_deaths': df_merged['Total_deaths'].values[rows],
+                       'Population': population,
+                       'area': area,
+                       'age': df_merged['Median_age'].values[rows] * population,
+                       'urban': df_merged['Urban_Population_ratio'].values[rows] * population})
+
+    df_rollup = df.groupby([by, 'Date'], sort=False).sum().reset_index()
+
+    df_rollup['Median_age'] = df_rollup.pop('age') / df_rollup['Population']
+    df_rollup['Urban_Population_ratio'] = df_rollup.pop('urban') / df_rollup['Population']
+    df_rollup['Pop_km2'] = df_rollup['Population'] / df_rollup.pop('area')
+
+    columns = [col for col in df_merged.columns if col in df_rollup.columns]
+
+    return df_rollup[columns]
+
+def _segment_starts(*columns):
+    '''
+    This function marks where a new segment begins in arrays sorted by segment, ie. the first row and
+    every row where any of the given columns differs from the row before.
+
+    Args:
+        columns (arrays): one or more arrays of equal length
+
+    Returns:
+        starts (array): boolean array, True on the first row of each segment
+    '''
+
+    starts = np.zeros(len(columns[0]), dtype=bool)
+    starts[:1] = True
+
+    for values in columns:
+        if isinstance(values, pd.Categorical):
+            values = values.codes
+        starts[1:] |= values[1:] != values[:-1]
+
+    return starts
+
+
+def _add_date_cols(df):
+    '''
+    This function adds the columns that only depend on the row itself: 'Year_week' (as the first column),
+    'Total_deaths_per_100k' and 'Weekday'.
+
+    Args:
+        df (dataframe): df containing covid-19 data as well as population data
+
+    Returns:
+        this function does not return anything; df is updated in place
+    '''
+
+    # 'Year_week' is formatted once per distinct date rather than once per row
+    date_codes, dates = pd.factorize(df['Date'])
+    df.insert(0, 'Year_week', pd.DatetimeIndex(dates).strftime('%G-%V')[date_codes])
+
+    df['Total_deaths_per_100k'] = 100000*df['Total_deaths']/(df['Population'] + 1.0)
+
+    df['Weekday'] = df['Date'].dt.weekday
+
+
+def _add_weekly_cols(df, country_start, deaths_lastweek_start=0):
+    '''
+    This function adds 'Deaths_week', 'Deaths_lastweek', 'Infection_rate' and the per 100k columns,
+    based on the 'Deaths' column of a dataframe sorted by country, then date.
+
+    Args:
+        df (dataframe): df with 'Year_week', 'Deaths' and 'Population' columns
+        country_start (array): boolean array, True on the first row of each country
+        deaths_lastweek_start (float or array) (optional): 'Deaths_lastweek' of the first week of each
+            country, ie. the deaths of the week before the data starts
+
+    Returns:
+        this function does not return anything; df is updated in place
+    '''
+
+    week_start = country_start | _segment_starts(df['Year_week'].values)
+
+    # weekly sums, one element per (country, week) segment
+    week_id = np.cumsum(week_start) - 1
+
+    deaths_week = np.bincount(week_id, weights=df['Deaths'].values)
+
+    deaths_lastweek = np.zeros(len(deaths_week))
+    deaths_lastweek[1:] = deaths_week[:-1]
+    deaths_lastweek[country_start[week_start]] = deaths_lastweek_start
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        infection_rate = deaths_week / deaths_lastweek
+
+    infection_rate[np.isnan(infection_rate)] = 0
+    infection_rate[infection_rate == np.inf] = 0
+
+    df['Deaths_week'] = deaths_week[week_id]
+    df['Deaths_lastweek'] = deaths_lastweek[week_id]
+    df['Infection_rate'] = infection_rate[week_id]
+
+    df['Deaths_per_100k'] = 100000*df['Deaths']/(df['Population'] + 1.0)
+    df['Deaths_week_per_100k'] = 100000*df['Deaths_week']/(df['Population'] + 1.0)
+
+
+def _add_rolling_cols(df, country_start, windows=ROLLING_WINDOWS):
+    '''
+    This function adds the rolling window columns, based on the 'Deaths' column of a dataframe sorted by
+    country, then date. For a window of w days these are:
+
+    - 'Deaths_sum{w}': the deaths of the last w days
+    - 'Deaths_s{w}': the daily mean of the last w days ('Deaths_s7' is the seven day smoothing)
+    - 'Deaths_per_100k_s{w}': 'Deaths_s{w}' per 100k inhabitants
+    - 'Deaths_growth{w}': the deaths of the last w days over the deaths of the w days before
+      ('Deaths_growth7' is the week-over-week growth); 0 where that is not defined, as for 'Infection_rate'
+
+    A window holds the w calendar days up to and including the date of the row. Days without a row,
+    including the days before a country's first row, count as zero deaths.
+
+    The sums are differences of the running total of 'Deaths' over all rows. The row where a window begins
+    is found with a binary search on (country, date), so every window is a few passes over the arrays,
+    for all countries at once.
+
+    Args:
+        df (dataframe): df with 'Date', 'Deaths' and 'Population' columns
+        country_start (array): boolean array, True on the first row of each country
+        windows (list) (optional): the window lengths in days
+
+    Returns:
+        this function does not return anything; df is updated in place
+    '''
+
+    # (country, date) as one increasing integer: the country's segment number in the high bits, the day
+    # in the low bits. Going back w days never crosses into the previous country's keys.
+    segment = np.cumsum(country_start, dtype=np.int64) - 1
+    days = df['Date'].values.astype('datetime64[D]').astype(np.int64)
+    keys = (segment << 32) + days
+
+    # running total of the deaths, with a zero in front: the deaths of rows i:j are running[j] - running[i]
+    running = np.zeros(len(df) + 1)
+    np.cumsum(df['Deaths'].values, out=running[1:])
+
+    population = df['Population'].values.astype(np.float64) + 1.0
+
+    for w in windows:
+
+        start = running[np.searchsorted(keys, keys - w, side='right')]
+        start_before = running[np.searchsorted(keys, keys - 2*w, side='right')]
+
+        deaths = running[1:] - start
+        deaths_before = start - start_before
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = deaths / deaths_before
+
+        growth[~np.isfinite(growth)] = 0
+
+        df['Deaths_sum{}'.format(w)] = deaths
+        df['Deaths_s{}'.format(w)] = deaths / w
+        df['Deaths_per_100k_s{}'.format(w)] = 100000*(deaths / w)/population
+        df['Deaths_growth{}'.format(w)] = growth
+
+
+def _daily_deaths(total_deaths, country_start, total_deaths_start=0):
+    '''
+    This function calculates new daily deaths from the total deaths of data sorted by country, then date.
+
+    Args:
+        total_deaths (array): total deaths
+        country_start (array): boolean array, True on the first row of each country
+        total_deaths_start (float or array) (optional): total deaths the day before each country's first row
+
+    Returns:
+        deaths (array): new daily deaths
+    '''
+
+    total_deaths = total_deaths.astype(float)
+
+    total_deaths_yesterday = np.zeros(len(total_deaths))
+    total_deaths_yesterday[1:] = total_deaths[:-1]
+    total_deaths_yesterday[country_start] = total_deaths_start
+
+    return total_deaths - total_deaths_yesterday
+
+
+@timed('add_calculated_cols')
+def add_calculated_cols(df_merged, key='Country_id'):
+    '''
+    This function adds some calculated columns to the dataframe
+
+    The rows are ordered by country (in the order the countries first appear), then date, so that every
+    country is one contiguous segment. The daily and weekly numbers are then calculated for all countries
+    at once on the underlying arrays, using masks that mark where a new country or a new week begins.
+
+    The series are countries by default; any other level of the hierarchical data (see 'build_hierarchy')
+    works the same way with its own key column.
+
+    Args:
+        df_merged (dataframe): df containing covid-19 data as well as population data
+        key (str) (optional): the column identifying a series, 'Country_id' for countries
+
+    Returns:
+        df_full (dataframe): With new calculated columns added
+    '''
+
+    # order rows by country, then date. Rows without a key are left out.
+    country_codes = pd.factorize(df_merged[key])[0]
+    order = np.lexsort((df_merged['Date'].values, country_codes))
+    order = order[country_codes[order] >= 0]
+
+    df = df_merged.iloc[order].reset_index(drop=True)
+
+    _add_date_cols(df)
+
+    country_start = _segment_starts(df[key].values)
+
+    # new daily deaths; the first day of each country is compared to zero
+    df['Deaths'] = _daily_deaths(df['Total_deaths'].values, country_start)
+
+    # the week before the first week of each country counts as zero
+    _add_weekly_cols(df, country_start)
+
+    _add_rolling_cols(df, country_start)
+
+    return df
+
+
+def append_calculated_cols(df_full, df_merged):
+    '''
+    This function updates a dataframe with calculated columns with the dates in df_merged that come after
+    its last date, without recalculating the history.
+
+    Only the new rows and the stored rows of the last week of each country (whose weekly numbers change
+    when days are added to that week) are calculated, starting from the stored total deaths and last week's
+    deaths of each country; their rolling windows only need the stored rows of the days the windows reach
+    back to. That block is then put in place of the stored last weeks with positional inserts, so apart
+    from copying the stored rows once, the cost depends on the number of new rows and countries rather
+    than on the length of the history. New countries are placed by their id, like
+    add_calculated_cols orders the merged data. The result is the same as running add_calculated_cols on
+    the full history, as long as the history itself has not changed.
+
+    Args:
+        df_full (dataframe): dataframe returned by add_calculated_cols (or by this function)
+        df_merged (dataframe): merged data; only the dates after the last date of df_full are used
+
+    Returns:
+        df_full (dataframe): updated dataframe with calculated columns
+    '''
+
+    n = len(df_full)
+    ids = df_full['Country_id'].values.astype(np.int64)
+
+    # the stored country segments: first and last row of each
+    starts = np.flatnonzero(_segment_starts(ids))
+    ends = np.r_[starts[1:], n] - 1
+    stored = ids[starts]
+
+    df_new = df_merged[df_merged['Date'].values > df_full['Date'].values[ends].max()]
+
+    if df_new.empty:
+        return df_full
+
+    # the countries getting new rows; stored ones by their segment, new ones by where their id belongs
+    countries = np.unique(df_new['Country_id'].values.astype(np.int64))
+    segment = pd.Index(stored).get_indexer(countries)
+    is_stored = segment >= 0
+    place = np.searchsorted(stored, countries)
+    rank = np.where(is_stored, segment, place - 0.5)
+
+    # the stored tail of each of those countries: the rows of its last week, at most the last 7 rows
+    end = ends[segment[is_stored]]
+    back = end[:, None] - np.arange(7)[None, :]
+    year_week = df_full['Year_week'].values
+    same_week = (back >= starts[segment[is_stored]][:, None]) & (year_week[np.maximum(back, 0)] == year_week[end][:, None])
+    tail_start = end - same_week.sum(axis=1) + 1
+
+    # taken column by column, since taking rows of the whole frame would first consolidate all of it
+    tail_rows = np.concatenate([np.arange(a, b + 1) for a, b in zip(tail_start, end)])
+    df_tail = pd.DataFrame({col: df_full[col].values[tail_rows] for col in df_full.columns})
+
+    df_new = df_new.reset_index(drop=True)
+    _add_date_cols(df_new)
+
+    df = pd.concat([df_tail, df_new], sort=False, ignore_index=True)
+
+    # ordered by country, then date: within each country the tail rows come before the new rows
+    row_rank = pd.Series(rank, index=countries)[df['Country_id'].values.astype(np.int64)].values
+    order = np.lexsort((df['Date'].values, row_rank))
+    is_new = np.r_[np.zeros(len(df_tail), dtype=bool), np.ones(len(df_new), dtype=bool)][order]
+
+    df = df.iloc[order].reset_index(drop=True)
+
+    country_start = _segment_starts(df['Country_id'].values)
+
+    # the stored tail rows keep their daily deaths; the new rows are compared to the day before
+    deaths = _daily_deaths(df['Total_deaths'].values, country_start)
+    df['Deaths'] = np.where(is_new, deaths, df['Deaths'].values)
+
+    # the first week of a country here is its stored last week, which knows the week before it
+    deaths_lastweek_start = df['Deaths_lastweek'].fillna(0).values[country_start]
+    _add_weekly_cols(df, country_start, deaths_lastweek_start)
+
+    # where each country's block goes: in place of its stored tail, or (for a new country) before the
+    # stored country that follows it
+    by_rank = np.argsort(rank, kind='stable')
+    insert_at = np.where(is_stored, 0, np.r_[starts, n][place])
+    insert_at[is_stored] = tail_start
+    resume_at = insert_at.copy()
+    resume_at[is_stored] = end + 1
+
+    block_start = np.flatnonzero(country_start)
+    block_end = np.r_[block_start[1:], len(df)]
+
+    # the rolling windows of a block reach back 2*max(windows) days, so at most that many stored rows
+    # before it. They are calculated on the blocks with those rows in front, which leaves the windows of
+    # the stored rows before the blocks as they are.
+    reach = 2*max(ROLLING_WINDOWS)
+    rows = []
+
+    for k, c in enumerate(by_rank):
+        first = starts[segment[c]] if is_stored[c] else insert_at[c]
+        rows.append(np.r_[np.arange(max(first, insert_at[c] - reach), insert_at[c]),
+                          n + np.arange(block_start[k], block_end[k])])
+
+    window_country = np.repeat(np.arange(len(rows)), [len(r) for r in rows])
+    rows = np.concatenate(rows)
+    in_block = rows >= n
+
+    df_window = pd.DataFrame(index=pd.RangeIndex(len(rows)))
+
+    for col in ['Date', 'Deaths', 'Population']:
+        values = np.empty(len(rows), dtype=df[col].dtype)
+        values[~in_block] = df_full[col].values[rows[~in_block]]
+        values[in_block] = df[col].values[rows[in_block] - n]
+        df_window[col] = values
+
+    _add_rolling_cols(df_window, _segment_starts(window_country))
+
+    for col in ROLLING_COLS:
+        df[col] = df_window[col].values[in_block]
+
+    df = df[df_full.columns]
+
+    # the result alternates between runs of stored rows and country blocks
+    runs = []
+    previous = 0
+
+    for k, c in enumerate(by_rank):
+        runs.append((previous, insert_at[c], block_start[k], block_end[k]))
+        previous = resume_at[c]
+
+    columns = {}
+
+    for col in df_full.columns:
+        stored_values = df_full[col].values
+        block_values = df[col].values
+        parts = []
+        for stored_from, stored_to, block_from, block_to in runs:
+            parts.append(stored_values[stored_from:stored_to])
+            parts.append(block_values[block_from:block_to])
+        parts.append(stored_values[previous:])
+        columns[col] = np.concatenate(parts)
+
+    # the arrays are new, so they are used as they are rather than copied into consolidated blocks
+    return pd.DataFrame(columns, copy=False)
+
+
+def data_version(data_path=DATA_PATH, popdata_path=POPDATA_PATH):
+    '''
+    This function identifies the version of the source data by the modification time and size
+    of the covid-19 data file and the population data file. Any change to either file gives a new version.
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+
+    Returns:
+        version (tuple): (modification time in ns, size in bytes) for each of the two files
+    '''
+
+    version = []
+
+    for path in (data_path, popdata_path):
+        stat = os.stat(path)
+        version.append((stat.st_mtime_ns, stat.st_size))
+
+    return tuple(version)
+
+
+def get_processed_data(data_path=DATA_PATH, popdata_path=POPDATA_PATH, snapshot_dir=SNAPSHOT_DIR, compact=COMPACT):
+    '''
+    This function returns the processed dataset, ie. the merged data with the calculated columns added.
+    It is built once per data version and then reused, so the csv files are only read and wrangled
+    again when one of them has changed on disk.
+
+    The processed dataset is also stored as a columnar snapshot in snapshot_dir. A new process (such as
+    a freshly started gunicorn worker) loads the snapshot instead of parsing the csv files, as long as
+    the snapshot was built from the current data version.
+
+    The returned dataframe is shared between callers and must not be modified in place.
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+        snapshot_dir (str) (optional): directory of the snapshot, None to not use a snapshot
+        compact (boolean) (optional): True to get the dataset in compact form (see 'compact_data')
+
+    Returns:
+        df_full (dataframe): merged data with calculated columns
+    '''
+
+    version = data_version(data_path, popdata_path)
+    key = (data_path, popdata_path, version, compact)
+
+    with _processed_lock:
+
+        if _processed['key'] == key:
+            count('pandemic_cache_requests_total', cache='processed', result='hit')
+
+        else:
+            count('pandemic_cache_requests_total', cache='processed', result='miss')
+
+            df_full = read_snapshot(snapshot_dir, [PROCESSED_VERSION, version, compact, ROLLING_WINDOWS]) if snapshot_dir else None
+
+            count('pandemic_cache_requests_total', cache='snapshot', result='miss' if df_full is None else 'hit')
+
+            if df_full is None:
+                df_full = _build_processed_data(data_path, popdata_path, snapshot_dir, compact, version)
+
+            _processed['df_full'] = df_full
+            _processed['derived'] = {}
+            _processed['derived_locks'] = {}
+            _processed['key'] = key
+
+        return _processed['df_full']
+
+
+def _build_processed_data(data_path, popdata_path, snapshot_dir, compact, version):
+    '''
+    This function builds the processed dataset and stores it as the snapshot. With a snapshot directory only
+    one process builds at a time (see 'build_lock'); a process that had to wait loads the snapshot the other
+    one has just written instead of building the same dataset again.
+
+    Args:
+        data_path (str): path to covid-19 data file
+        popdata_path (str): path to the population data file
+        snapshot_dir (str): directory of the snapshot, or None
+        compact (boolean): True to build the dataset in compact form (see 'compact_data')
+        version (tuple): data version, see 'data_version'
+
+    Returns:
+        df_full (dataframe): merged data with calculated columns
+    '''
+
+    if not snapshot_dir:
+        df_full = add_calculated_cols(merge_data(data_path, popdata_path))
+        return compact_data(df_full) if compact else df_full
+
+    with build_lock(snapshot_dir):
+
+        df_full = read_snapshot(snapshot_dir, [PROCESSED_VERSION, version, compact, ROLLING_WINDOWS])
+
+        if df_full is not None:
+            return df_full
+
+        df_full = add_calculated_cols(merge_data(data_path, popdata_path))
+
+        if compact:
+            df_full = compact_data(df_full)
+
+        try:
+            store_processed_data(df_full, data_path, popdata_path, snapshot_dir, compact)
+        except OSError as e:
+            # not being able to store the snapshot only costs start-up time
+            logger.warning('Could not write snapshot to %s: %s', snapshot_dir, e)
+
+    return df_full
+
+
+def store_processed_data(df_full, data_path=DATA_PATH, popdata_path=POPDATA_PATH, snapshot_dir=SNAPSHOT_DIR,
+                         compact=COMPACT):
+    '''
+    This function stores a processed dataset as the snapshot for the current version of the given source files.
+
+    Since the data version only depends on modification time and size, a file that is moved into place with
+    os.replace afterwards keeps the version, and the snapshot is picked up under its new path.
+
+    Args:
+        df_full (dataframe): merged data with calculated columns
+        data_path (str) (optional): path to covid-19 data file the dataset was built from
+        popdata_path (str) (optional): path to the population data file the dataset was built from
+        snapshot_dir (str) (optional): directory of the snapshot
+        compact (boolean) (optional): True to store the dataset in compact form (see 'compact_data')
 
     Returns:
         this function does not return anything
     '''
 
-    df = pd.read_csv(data_path) # population dataset read into dataframe
+    if compact:
+        df_full = compact_data(df_full)
+
+    write_snapshot(df_full, snapshot_dir, [PROCESSED_VERSION, data_version(data_path, popdata_path), compact,
+                                        ROLLING_WINDOWS])
+
+
+def compact_data(df_full):
+    '''
+    This function returns a compact version of the processed dataset, which takes a fraction of the memory:
+
+    - 'Country', 'ISO' and 'Continent' become categories
+    - 'Year_week' becomes an integer (year*100 + week, for instance 202021 for '2020-21')
+    - numeric columns holding whole numbers get the smallest integer type that fits them
+    - other numeric columns become float32
+    - the per 100k columns are left out; 'add_per_100k_cols' recalculates them from 'Population'
+
+    Applying it to a dataframe that is compact already changes nothing.
+
+    Args:
+        df_full (dataframe): merged data with calculated columns
+
+    Returns:
+        df (dataframe): compact version of df_full
+    '''
+
+    df = df_full.drop(columns=[col for col in PER_100K_COLS if col in df_full])
+
+    for col in ['Country', 'ISO', 'Continent']:
+        df[col] = df[col].astype('category')
+
+    if df['Year_week'].dtype == object:
+        codes, year_weeks = pd.factorize(df['Year_week'])
+        df['Year_week'] = pd.Index(year_weeks).str.replace('-', '').astype(np.int32)[codes]
 
-    # clean data
+    for col in df.select_dtypes('number').columns:
 
-    df = df.rename(columns={"ObservationDate": "Date", "Country/Region": "Country"})
+        values = df[col]
 
-    df = df.groupby(['Country', 'Date']).sum().reset_index()
+        if values.notna().all() and (values % 1 == 0).all():
+            df[col] = pd.to_numeric(values, downcast='integer')
+        else:
+            df[col] = values.astype(np.float32)
+
+    return df
 
-    # update some of the country names to match the ones used in the population dataset
 
-    df['Country'] = df['Country'].replace({'UK': 'United Kingdom',
-                                           'US': 'United States',
-                                           'Mainland China': 'China',
-                                           'Czech Republic': 'Czechia',
-                                           'Burma': 'Myanmar'
-                                           })
-    try:
-        df['Country'] = df['Country'].replace({"('St. Martin',)": "St. Martin",
-                                               "occupied Palestinian territory": "Palestine",
-                                               "State of Palestine": "Palestine",
-                                               "Ivory Coast": "Cote d'Ivoire",
-                                               "Gambia, The": "Gambia",
-                                               "The Gambia": "Gambia",
-                                               "The Bahamas": "Bahamas",
-                                               "Bahamas, The": "Bahamas",
-                                               "Republic of Ireland": "Ireland",
-                                               "Republic of the Congo": "Congo (Brazzaville)",
-                                               " Azerbaijan": "Azerbaijan"
+def expand_data(df):
+    '''
+    This function turns a compact processed dataset (see 'compact_data') back into the regular form, with
+    string columns, 64 bit numbers and the per 100k columns, in the regular column order. Applying it to a
+    dataframe in regular form changes nothing. The given dataframe is never modified; it may be the shared
+    processed dataset (see 'get_processed_data').
+
+    Args:
+        df (dataframe): processed dataset, compact or not
+
+    Returns:
+        df_full (dataframe): processed dataset in regular form
+    '''
+
+    # add_per_100k_cols returns df itself when nothing is missing, ie. in regular form
+    df_full = add_per_100k_cols(df)
+    df = df_full.copy() if df_full is df else df_full
+
+    for col in ['Country', 'ISO', 'Continent']:
+        df[col] = df[col].astype(object)
+
+    if df['Year_week'].dtype != object:
+        codes, year_weeks = pd.factorize(df['Year_week'])
+        df['Year_week'] = pd.Index(['{}-{:02d}'.format(v // 100, v % 100) for v in year_weeks])[codes]
+
+    for col in ['Total_deaths', 'Weekday']:
+        df[col] = df[col].astype(np.int64)
+
+    df['Country_id'] = df['Country_id'].astype(np.int32)
+
+    for col in df.select_dtypes('number').columns.drop(['Total_deaths', 'Weekday', 'Country_id']):
+        df[col] = df[col].astype(np.float64)
+
+    return df[['Year_week', 'Date', 'Continent', 'Country', 'ISO', 'Country_id', 'Population', 'Urban_Population_ratio',
+               'Pop_km2', 'Median_age', 'Total_deaths', 'Total_deaths_per_100k', 'Weekday', 'Deaths',
+               'Deaths_week', 'Deaths_lastweek', 'Infection_rate', 'Deaths_per_100k', 'Deaths_week_per_100k']
+              + ROLLING_COLS]
+
+
+def add_per_100k_cols(df):
+    '''
+    This function adds the per 100k columns that are left out in compact mode. Columns already there are kept.
+
+    Args:
+        df (dataframe): processed dataset or a selection of it
+
+    Returns:
+        df (dataframe): with the per 100k columns
+    '''
+
+    missing = [col for col in PER_100K_COLS if col not in df]
+
+    if not missing:
+        return df
+
+    df = df.copy()
+
+    for col in missing:
+        df[col] = 100000*df[PER_100K_COLS[col]].astype(np.float64)/(df['Population'].astype(np.float64) + 1.0)
+
+    return df
+
+
+def memory_report(df):
+    '''
+    This function reports the memory used by each column of a dataframe, including the strings
+    held by object columns.
+
+    Args:
+        df (dataframe): any dataframe, for instance the processed dataset
+
+    Returns:
+        report (dataframe): dtype and bytes per column, largest first, with a 'Total' row at the end
+    '''
+
+    usage = df.memory_usage(deep=True, index=False)
+
+    report = pd.DataFrame({'dtype': df.dtypes.astype(str), 'bytes': usage}).sort_values('bytes', ascending=False)
+    report.loc['Total'] = ['', usage.sum()]
+
+    return report
+
+
+def get_derived(name, builder):
+    '''
+    This function memoizes an artifact derived from the processed dataset, such as a date selection.
+    The artifact is built by calling builder(df_full) the first time it is requested for the current
+    data version, and it is rebuilt once the source data changes.
+
+    Every artifact is built under its own lock, so threads building different artifacts (such as the
+    figures built in parallel by 'return_figures') do not wait for each other, while an artifact asked for
+    by several threads at once is still only built once.
+
+    The returned artifact is shared between callers and must not be modified in place.
+
+    Args:
+        name (str): unique name of the artifact
+        builder (function): function taking the processed dataset and returning the artifact
+
+    Returns:
+        the artifact returned by builder
+    '''
+
+    df_full = get_processed_data()
+
+    with _processed_lock:
+
+        # the dataset may have been swapped by another thread since we fetched it
+        if _processed['df_full'] is not df_full:
+            return builder(df_full)
+
+        derived = _processed['derived']
+        lock = _processed['derived_locks'].setdefault(name, threading.Lock())
+
+    with lock:
+
+        if name in derived:
+            count('pandemic_cache_requests_total', cache='derived', result='hit')
+        else:
+            count('pandemic_cache_requests_total', cache='derived', result='miss')
+            derived[name] = builder(df_full)
+
+        return derived[name]
+
+
+@timed('dates_choice')
+def dates_choice(df, all_dates=False, weekly=False, key='Country_id'):
+    '''
+    This function selects dates based on input. There are three types
+
+    1. Historic daily data (all_dates=True)
+    2. Historic weekly data (weekly=True, all_dates=False)
+    2. Latest date data (weekly=False, all_dates=False)
+
+    The historic data will be suitable for performing time series analysis.
+
+    The latest date data will be suitable to look at the overall picture (such as accumulated death
+    count per country).
+
+    Args:
+        df (dataframe): df containing covid-19 data as well as population data
+
+        all_dates (boolean): Optional argument - True if you wish to get daily historic data
+
+        weekly (boolean): Optional argument - True if you wish to get historic weekly data
+
+        key (str): Optional argument - the column identifying a series (see 'add_calculated_cols')
+
+    Returns:
+        df (dataframe): Based on choices
+    '''
+
+    if all_dates:
+
+        # No filtering required since all_dates is requested
 
-                                              })
-    except:
         pass
 
-    # sort on Country, then Date. Mostly it is only one row getting grouped, whereever data is on regional
-    # groupby ensures we get the data summed up to country level
-    df_covid = df.groupby(['Country', 'Date']).sum().reset_index()
+    else:
+
+        if weekly:
 
-    # dropping columns we will not use.
-    df_covid.drop(['SNo', 'Confirmed', 'Recovered'], axis=1, inplace=True)
+            # we wish to filter on Sundays because that is always the last day of each 'Year_week'
+            # (for instance last day of week 20, 21, 22 etc. is always a Sunday). However, due to the
+            # fact that earlier applied function 'add_calculated_cols' does a simple groupby('Year_week')
+            # to obtain the aggregated weekly numbers, the first aggregation for each country will often
+            # be based on less than seven days. So we leave out the first Sunday of each country, unless
+            # the country's data starts on a Monday (in which case the first week is complete).
+
+            df = weekly_snapshot(df, key)
+
+        else:
 
-    df_covid.columns = ['Country', 'Date', 'Total_deaths']
+            # In this case we have neither asked for all dates nor weekly dates,
+            # which means we will get the last date only.
+
+            df = df[df.Date == df.Date.max()].reset_index(drop=True)
+
+
+    # we set the dates as index and make sure it is in datetime format
+
+    df = df.reset_index(drop=True).set_index('Date')
+    df.index = pd.to_datetime(df.index, infer_datetime_format=True)
+
+    # in compact mode the per 100k columns are only calculated for the selected rows
+    df = add_per_100k_cols(df)
+
+    return df
+
+def weekly_snapshot(df, key='Country_id'):
+    '''
+    This function selects the rows with the weekly numbers, ie. the last day (Sunday) of each full week,
+    from a dataframe sorted by country then date.
+
+    The first week of a country is usually not a full week, because the data for the country does not start
+    on a Monday. Its Sunday is then left out. The selection is made with masks marking the first row and
+    the first Sunday of each country, and the input dataframe is left unchanged.
+
+    Args:
+        df (dataframe): df with calculated columns, sorted by country then date
+        key (str) (optional): the column identifying a series (see 'add_calculated_cols')
+
+    Returns:
+        df_weekly (dataframe): the selected Sunday rows
+    '''
+
+    weekday = df['Weekday'].values
+
+    # True on the first row of each country
+    country_start = _segment_starts(df[key].values)
+
+    country_id = np.cumsum(country_start) - 1
+
+    sunday = weekday == 6
+
+    # True on the first Sunday of each country: the number of Sundays seen so far (this one included)
+    # equals the number seen before the country started, plus one
+    sundays_seen = np.cumsum(sunday)
+    sundays_before_country = (sundays_seen - sunday)[country_start]
+    first_sunday = sunday & (sundays_seen - sundays_before_country[country_id] == 1)
+
+    # the first week is partial whenever the country's first day is not a Monday
+    partial_first_week = weekday[country_start][country_id] > 0
+
+    df_weekly = df[sunday & ~(first_sunday & partial_first_week)]
+
+    return df_weekly
+
+
+def get_selection(kind, level='country'):
+    '''
+    This function returns a date selection of the processed dataset (see 'dates_choice'),
+    built once per data version. For the levels other than 'country' the selection is taken from
+    the hierarchical data (see 'build_hierarchy').
+
+    Args:
+        kind (str): 'latest', 'daily' or 'weekly'
+        level (str) (optional): 'region', 'country' or 'continent'
+
+    Returns:
+        df (dataframe): the date selection, with Date as index
+    '''
+
+    if level == 'country':
+        return get_derived(kind, lambda df_full: dates_choice(df_full, **DATE_SELECTIONS[kind]))
+
+    return get_derived('{}_{}'.format(level, kind), lambda df_full: dates_choice(
+        get_hierarchy()[level], key=LEVEL_KEYS[level], **DATE_SELECTIONS[kind]))
+
+
+def build_hierarchy(data_path=DATA_PATH, popdata_path=POPDATA_PATH, region_popdata_path=REGION_POPDATA_PATH):
+    '''
+    This function builds the hierarchical data: the processed data per province/state ('region'), and
+    its rollups per country and per continent. The covid-19 data file is read once, on the region level;
+    the countries are summed up from the regions and the continents from the countries, and each level
+    gets the calculated columns of its own totals (the daily and weekly numbers of a country are not the
+    sums of its regions' numbers when the regions report on different days).
+
+    The country level equals the processed dataset of 'get_processed_data'.
+
+    Args:
+        data_path (str) (optional): path to covid-19 data file
+        popdata_path (str) (optional): path to the population data file
+        region_popdata_path (str) (optional): path to the region population file
+
+    Returns:
+        hierarchy (dict): processed dataframe per level ('region', 'country' and 'continent')
+    '''
+
+    df_region = merge_region_data(data_path, popdata_path, region_popdata_path)
+
+    df_country = df_region.groupby(['Country_id', 'Date'])['Total_deaths'].sum().reset_index()
+    df_country = _join_popdata(df_country, get_country_dimension(popdata_path)[0])
+
+    df_continent = rollup(df_country, 'Continent')
+
+    merged = {'region': df_region, 'country': df_country, 'continent': df_continent}
+
+    return {level: add_calculated_cols(df, key=LEVEL_KEYS[level]) for level, df in merged.items()}
+
+
+def get_hierarchy():
+    '''
+    This function returns the hierarchical data (see 'build_hierarchy') for the current data version.
+    It is only built the first time it is asked for, so it costs nothing unless a region or continent
+    level is used.
+
+    Args:
+        None
+
+    Returns:
+        hierarchy (dict): processed dataframe per level ('region', 'country' and 'continent')
+    '''
 
-    return df_covid
+    return get_derived('hierarchy', lambda df_full: build_hierarchy())
 
 
-def merge_data():
+def get_country_ids():
     '''
-    This function get the population data and the covid-19 data and merges it to one dataframe
+    This function returns the countries of the processed dataset with their 'Country_id' and 'Continent',
+    indexed by country name, built once per data version from the first row of every country. Filters on
+    country names or continents look the names up here once and then select the rows on 'Country_id'.
 
     Args:
         None
 
     Returns:
-        df_merged (dataframe): merged data
+        df_countries (dataframe): 'Country_id' and 'Continent', indexed by 'Country'
     '''
 
-    popdata_path = 'data/population_2020_for_johnhopkins_data.csv'
-    data_path = 'data/covid_19_data.csv'
-
-    df_pop = get_popdata(popdata_path)
+    def build(df_full):
+        first = _segment_starts(df_full['Country_id'].values)
+        return pd.DataFrame({'Country_id': df_full['Country_id'].values[first],
+                             'Continent': np.asarray(df_full['Continent'])[first]},
+                            index=pd.Index(np.asarray(df_full['Country'])[first], name='Country'))
 
-    df_covid = get_covid_data(data_path)
+    return get_derived('country_ids', build)
 
-    df_merged = df_covid.set_index('Country').join(df_pop.set_index('Country')).reset_index()
 
-    df_merged.dropna(subset=['Population'], inplace=True)
+def select_countries(df, countries):
+    '''
+    This function filters the dataframe on a list of countries, on the integer 'Country_id' of the rows
 
+    Args:
+        df (dataframe): Dataset including a column 'Country_id'
+        countries (list): country names; names without data are ignored
 
+    Returns:
+        df_countries (dataframe): Dataframe with only data from the listed countries
+    '''
 
-    df_merged = df_merged[['Date', 'Continent', 'Country', 'ISO', 'Population', 'Urban_Population_ratio', 'Pop_km2', 'Median_age', 'Total_deaths']]
+    df_ids = get_country_ids()
+    found = df_ids.index.get_indexer(list(countries))
 
-    df_merged.Date = pd.to_datetime(df_merged.Date, infer_datetime_format=True)
+    return df[np.isin(df['Country_id'].values, df_ids['Country_id'].values[found[found >= 0]])]
 
-    return df_merged
 
-def add_calculated_cols(df_merged):
+def select_continent(df, continent):
     '''
-    This function adds some calculated columns to the dataframe
+    This function filters the dataframe on a single continent, on the integer 'Country_id' of the rows
 
     Args:
-        df_merged (dataframe): df containing covid-19 data as well as population data
+        df (dataframe): Dataset including a column 'Country_id'
+        continent (string): Name of continent. Valid values are found in below list
 
     Returns:
-        df_full (dataframe): With new calculated columns added
+        df_continent (dataframe): Dataframe with only data from a single contintent
     '''
-    df = df_merged.copy()
+    if continent:
 
-    df['Total_deaths_per_100k'] = 100000*df['Total_deaths']/(df['Population'] + 1.0)
+        assert continent in CONTINENTS, "Continent is not in CONTINENTS"
 
-    df['Weekday'] = df['Date'].dt.weekday
+        df_ids = get_country_ids()
+        ids = df_ids['Country_id'].values[df_ids['Continent'].values == continent]
 
-    df['Year_week'] = df['Date'].dt.strftime('%G-%V')
+        df_continent = df[np.isin(df['Country_id'].values, ids)]
 
-    country_codes = df.ISO.unique().tolist()
+    return df_continent
 
-    country_dfs = []
 
-    for code in country_codes:
+def rank_data(df_current, top_n = (None, None)):
+    '''
+    This function filters on the top n countries ranked on any of the following:
 
-        notgrouped = df[df['ISO'] == code]
+    - Population
+    - Pop_km2
+    - Urban_Population_ratio
+    - Median_age
+    - Deaths
+    - Deaths_per_100k
 
-        notgrouped['Total_deaths_yesterday'] = notgrouped['Total_deaths'].shift(1).fillna(0)
-        notgrouped['Deaths'] = notgrouped['Total_deaths'] - notgrouped['Total_deaths_yesterday']
-        #notgrouped['Shift1'] = notgrouped['Deaths'].shift(1).fillna(0)
-        #notgrouped['Shift2'] = notgrouped['Deaths'].shift(2).fillna(0)
-        #notgrouped['Shift3'] = notgrouped['Deaths'].shift(3).fillna(0)
-        #notgrouped['Shift4'] = notgrouped['Deaths'].shift(4).fillna(0)
-        #notgrouped['Shift5'] = notgrouped['Deaths'].shift(5).fillna(0)
-        #notgrouped['Shift6'] = notgrouped['Deaths'].shift(6).fillna(0)
-        #notgrouped['Deaths_s7'] = ((notgrouped['Deaths'] + notgrouped['Shift1'] + notgrouped['Shift2'] + \
-        #                          notgrouped['Shift3'] + notgrouped['Shift4'] + notgrouped['Shift5'] + \
-        #                          notgrouped['Shift6'])/7.0).astype(int)
-        #notgrouped['Deaths_per_100k_s7'] = 100000*notgrouped['Deaths_s7']/(notgrouped['Population'] + 1.0)
+    Args:
+        df_current (dataframe): dataframe with just the latest date
+        top_n (tuple): First element (str): variable name to base the ranking on
+                        Second element (int): the n in top_n
 
-        notgrouped.drop(['Total_deaths_yesterday'], axis=1, inplace=True)
-        notgrouped.set_index('Year_week', inplace=True)
 
-        grouped = notgrouped.groupby(['Year_week']).sum()
-        grouped.rename(columns={"Deaths": "Deaths_week"}, inplace=True)
-        grouped['Deaths_lastweek'] = grouped['Deaths_week'].shift(1).fillna(0)
-        grouped['Infection_rate'] =  (grouped['Deaths_week'] / grouped['Deaths_lastweek']).fillna(0).replace(np.inf, 0)
-        grouped = grouped[['Deaths_week', 'Deaths_lastweek', 'Infection_rate']]
+    Returns:
+        df (dataframe): ranked data
+    '''
 
-        regrouped = notgrouped.join(grouped)
+    # unpack tuple
 
+    var = top_n[0]
+    n = top_n[1]
 
-        country_dfs.append(regrouped)
+    assert var in VAR_LIST
 
-    df_full = pd.concat(country_dfs)
+    # limiting n so that it is not more than the number of rows (capped)
 
-    df_full['Deaths_per_100k'] = 100000*df_full['Deaths']/(df_full['Population'] + 1.0)
-    df_full['Deaths_week_per_100k'] = 100000*df_full['Deaths_week']/(df_full['Population'] + 1.0)
+    if n:
+        tot_countries = df_current.shape[0]
+        if n > tot_countries:
+            n = tot_countries
 
-    df_full.reset_index(inplace=True)
+    df = df_current.sort_values(by=[var], ascending=False)[:n]
 
-    return df_full
+    return df
 
 
-def dates_choice(df, all_dates=False, weekly=False):
+def ranking_index(df, var, name='Country', key='Country_id'):
     '''
-    This function selects dates based on input. There are three types
+    This function ranks the countries on a variable for every date of a date selection, for the whole
+    world and for every continent. The countries are ordered by descending value with missing values last,
+    like sort_values(var, ascending=False), and ties keep the order of the rows.
 
-    1. Historic daily data (all_dates=True)
-    2. Historic weekly data (weekly=True, all_dates=False)
-    2. Latest date data (weekly=False, all_dates=False)
+    Every array is indexed by date (position in 'dates') first:
 
-    The historic data will be suitable for performing time series analysis.
+    - 'rows': [date, country] the row of the country in df, or -1
+    - 'orders': per continent (None for the world), [date, rank] the row at that rank, padded with -1
+    - 'ranks': [date, country] the rank of the country in the world (0 is first), or -1
+    - 'continent_ranks': [date, country] the rank of the country in its continent, or -1
+    - 'counts': per continent (None for the world), [date] the number of ranked countries
 
-    The latest date data will be suitable to look at the overall picture (such as accumulated death
-    count per country).
+    so the top n rows of a date are a slice of 'orders', and the rank of a country on a date is one lookup.
+    Every country belongs to one continent ('continents' gives it per country), so the ranks within the
+    continents share one array, and the orders of a continent are only as wide as its largest count.
 
     Args:
-        df (dataframe): df containing covid-19 data as well as population data
-
-        all_dates (boolean): Optional argument - True if you wish to get daily historic data
-
-        weekly (boolean): Optional argument - True if you wish to get historic weekly data
+        df (dataframe): date selection from dates_choice (Date as index)
+        var (str): variable to rank on, one of VAR_LIST
+        name (str) (optional): the column naming the series, see LEVEL_NAMES
+        key (str) (optional): the column identifying the series, see LEVEL_KEYS
 
     Returns:
-        df (dataframe): Based on choices
+        ranking (dict): 'dates', 'countries', 'continents', 'rows', 'orders', 'ranks', 'continent_ranks'
+                        and 'counts'
     '''
 
-    if all_dates:
+    assert var in VAR_LIST
 
-        # No filtering required since all_dates is requested
+    date_idx, dates = pd.factorize(df.index, sort=True)
+    country_idx, keys = pd.factorize(df[key])
 
-        pass
+    # the name and the continent of every country, from its first row
+    all_rows = np.arange(len(df))
+    first = np.zeros(len(keys), dtype=np.int64)
+    first[country_idx[::-1]] = all_rows[::-1]
 
-    else:
+    countries = pd.Index(np.asarray(df[name])[first])
+    country_continent = np.asarray(df['Continent'])[first]
+    continent_idx = pd.Index(CONTINENTS).get_indexer(country_continent)[country_idx]
 
-        if weekly:
+    values = df[var].values.astype(float)
+    missing = np.isnan(values)
+    key = np.where(missing, 0, -values)
 
-            # we wish to filter on Sundays because that is always the last day of each 'Year_week'
-            # (for instance last day of week 20, 21, 22 etc. is always a Sunday). However, due to the
-            # fact that earlier applied function 'add_calculated_cols' does a simple groupby('Year_week')
-            # to obtain the aggregated weekly numbers, the first aggregation for each country will often
-            # be based on less than seven days. So before filtering we will change the value of those cases
+    shape = (len(dates), len(countries))
 
-            for i in range(df.shape[0]):
+    rows = np.full(shape, -1, dtype=np.int32)
+    rows[date_idx, country_idx] = all_rows
 
-                # looping dataframe, which is sorted by country then date
+    orders = {}
+    counts = {}
+    continent_ranks = np.full(shape, -1, dtype=np.int32)
 
-                # check if the current row is the first of a new country
+    for scope in [None] + CONTINENTS:
 
-                if i == 0:
+        selected = all_rows if scope is None else all_rows[continent_idx == CONTINENTS.index(scope)]
 
-                    new_country = True
+        # sorted by date, then missing values last, then descending value (lexsort is stable)
+        order = selected[np.lexsort((key[selected], missing[selected], date_idx[selected]))]
 
-                else:
+        order_date = date_idx[order]
+        rank = np.arange(len(order)) - np.searchsorted(order_date, order_date)
 
-                    if df.ISO[i] == df.ISO[i-1]:
+        counts[scope] = np.bincount(order_date, minlength=len(dates))
 
-                        new_country = False
+        orders[scope] = np.full((len(dates), counts[scope].max(initial=0)), -1, dtype=np.int32)
+        orders[scope][order_date, rank] = order
 
-                    else:
+        if scope is None:
+            ranks = np.full(shape, -1, dtype=np.int32)
+            ranks[order_date, country_idx[order]] = rank
+        else:
+            continent_ranks[order_date, country_idx[order]] = rank
 
-                        new_country = True
+    return {'dates': dates, 'countries': countries, 'continents': country_continent, 'rows': rows,
+            'orders': orders, 'ranks': ranks, 'continent_ranks': continent_ranks, 'counts': counts}
 
-                # if it is we find the row of the first '6', which could be on the current row
-                # or any of the next six rows.
-                # We change its value unless the weekday is '0' (in which case the first '6' will
-                # be the seventh element, and we do not have to change its value)
 
-                if new_country:
+def get_ranking_index(var, kind='latest', level='country'):
+    '''
+    This function returns the ranking index (see 'ranking_index') of a date selection on a variable,
+    built once per data version the first time it is asked for.
 
-                    wd = df.Weekday[i]
+    Args:
+        var (str): variable to rank on, one of VAR_LIST
+        kind (str) (optional): 'latest', 'daily' or 'weekly'
+        level (str) (optional): 'region', 'country' or 'continent'
 
-                    if wd > 0:
+    Returns:
+        ranking (dict): ranking index
+    '''
 
-                        diff = 6 - wd
-                        df.Weekday[i + diff] = 0
+    prefix = 'ranking' if level == 'country' else 'ranking_' + level
 
-            # Finally we filter the dataframe on Sundays
+    return get_derived('{}_{}_{}'.format(prefix, kind, var),
+                       lambda df_full: ranking_index(get_selection(kind, level), var,
+                                                     LEVEL_NAMES[level], LEVEL_KEYS[level]))
 
-            df = df[df.Weekday == 6]
 
-        else:
+def top_rows(ranking, n=None, date=None, continent=None):
+    '''
+    This function gets the rows of the top n countries on a date from a ranking index.
 
-            # In this case we have neither asked for all dates nor weekly dates,
-            # which means we will get the last date only.
+    Args:
+        ranking (dict): ranking index (see 'ranking_index')
+        n (int) (optional): number of countries, all if None
+        date (str or Timestamp) (optional): the date, the last date if None
+        continent (str) (optional): only rank the countries of this continent
 
-            df = df[df.Date == df.Date.max()].reset_index(drop=True)
+    Returns:
+        rows (array): rows of the date selection, best ranked first
+    '''
 
+    d = len(ranking['dates']) - 1 if date is None else ranking['dates'].get_loc(pd.Timestamp(date))
 
-    # we set the dates as index and make sure it is in datetime format
+    end = ranking['counts'][continent][d]
 
-    df = df.reset_index(drop=True).set_index('Date')
-    df.index = pd.to_datetime(df.index, infer_datetime_format=True)
+    return ranking['orders'][continent][d, :end if n is None else min(n, end)]
 
-    return df
 
-def select_continent(df, continent):
+def country_rank(ranking, country, date=None, continent=None):
     '''
-    This function filters the dataframe on a single continent
+    This function looks up the rank of a country on a date in a ranking index.
 
     Args:
-        df (dataframe): Dataset including a column 'Continent'
-        continent (string): Name of continent. Valid values are found in below list
+        ranking (dict): ranking index (see 'ranking_index')
+        country (str): the country
+        date (str or Timestamp) (optional): the date, the last date if None
+        continent (str) (optional): rank among the countries of this continent
 
     Returns:
-        df_continent (dataframe): Dataframe with only data from a single contintent
+        rank (int): 0 for the first country, or None if the country has no data on the date
     '''
-    if continent:
 
-        continent_list = ['America', 'Europe', 'Asia', 'Africa', 'Oceania']
+    d = len(ranking['dates']) - 1 if date is None else ranking['dates'].get_loc(pd.Timestamp(date))
 
-        assert continent in continent_list, "Continent is not in continent_list"
+    c = ranking['countries'].get_loc(country)
 
-        df_continent = df[df['Continent'] == continent]
+    if continent is None:
+        rank = ranking['ranks'][d, c]
+    elif ranking['continents'][c] == continent:
+        rank = ranking['continent_ranks'][d, c]
+    else:
+        return None
 
-    return df_continent
+    return None if rank < 0 else int(rank)
 
 
-def rank_data(df_current, top_n = (None, None)):
+def top_countries(var, n=None, date=None, kind='latest', continent=None, list_countries=None, level='country'):
     '''
-    This function filters on the top n countries ranked on any of the following:
-
-    - Population
-    - Pop_km2
-    - Urban_Population_ratio
-    - Median_age
-    - Deaths
-    - Deaths_per_100k
+    This function lists the top n countries of a date selection on a variable at a date,
+    using the ranking index of the selection.
 
     Args:
-        df_current (dataframe): dataframe with just the latest date
-        top_n (tuple): First element (str): variable name to base the ranking on
-                        Second element (int): the n in top_n
-
+        var (str): variable to rank on, one of VAR_LIST
+        n (int) (optional): number of countries, all if None
+        date (str or Timestamp) (optional): the date, the last date if None. NaT (the latest date of
+                                            an empty selection) gives no countries
+        kind (str) (optional): 'latest', 'daily' or 'weekly'
+        continent (str) (optional): only rank the countries of this continent
+        list_countries (list) (optional): only rank these countries
+        level (str) (optional): 'region', 'country' or 'continent'; the names are those of the level
 
     Returns:
-        df (dataframe): ranked data
+        countrylist (list): country names, best ranked first
     '''
 
-    var_list = ['Population', 'Pop_km2', 'Urban_Population_ratio', 'Median_age', 'Total_deaths', \
-                'Total_deaths_per_100k', 'Deaths', 'Deaths_per_100k', 'Deaths_s7', 'Deaths_per_100k_s7',
-                'Deaths_week', 'Deaths_lastweek', 'Infection_rate']
+    if date is pd.NaT:
+        return []
 
-    # unpack tuple
-
-    var = top_n[0]
-    n = top_n[1]
+    ranking = get_ranking_index(var, kind, level)
 
-    assert var in var_list
+    rows = top_rows(ranking, None if list_countries else n, date, continent)
 
-    # limiting n so that it is not more than the number of rows (capped)
-
-    if n:
-        tot_countries = df_current.shape[0]
-        if n > tot_countries:
-            n = tot_countries
+    countrylist = list(get_selection(kind, level)[LEVEL_NAMES[level]].values[rows])
 
-    df = df_current.sort_values(by=[var], ascending=False)[:n]
+    if list_countries:
+        listed = set(list_countries)
+        countrylist = [country for country in countrylist if country in listed][:n]
 
-    return df
+    return countrylist
 
 
+@timed('prepare_barplot')
 def prepare_barplot(continent=None, top_n = (None, None)):
     '''
     This funtion gets the current high level aggregated data suitable for bar plots.
@@ -375,32 +1618,30 @@ def prepare_barplot(continent=None, top_n = (None, None)):
         df_current (dataframe): dataframe with just the latest date prepared for barplot
     '''
 
-    df_merged = merge_data()
-
-    df_full = add_calculated_cols(df_merged)
-
-    df_current = dates_choice(df_full)
+    df_current = get_selection('latest')
 
     if continent:
-        df_current = select_continent(df_current, continent)
+        assert continent in CONTINENTS, "Continent is not in CONTINENTS"
 
-    var_list = ['Population', 'Pop_km2', 'Urban_Population_ratio', 'Median_age', 'Total_deaths', \
-                'Total_deaths_per_100k', 'Deaths', 'Deaths_per_100k', 'Deaths_s7', 'Deaths_per_100k_s7', \
-                'Deaths_week', 'Deaths_lastweek', 'Infection_rate']
 
     # assert that top_n tuple input is valid in case two (no-None) elements are provided
 
     if (len(top_n) == 2) and (top_n[0] and top_n[1]):
 
-        assert top_n[0] in var_list, "First tuple element in 'top_n' must be in var_list and of type String"
+        assert top_n[0] in VAR_LIST, "First tuple element in 'top_n' must be in VAR_LIST and of type String"
         assert isinstance(top_n[1], int) == True, "Second tuple element in 'top_n' must of type Integer"
 
-        df_current = rank_data(df_current, top_n)
+        # the top n rows (of the continent) are taken from the ranking index
+        df_current = df_current.iloc[top_rows(get_ranking_index(top_n[0]), top_n[1], continent=continent)]
+
+    elif continent:
+        df_current = select_continent(df_current, continent)
 
     df_current = df_current.reset_index().set_index('Country')
 
     return df_current
 
+@timed('prepare_time')
 def prepare_time(continent=None, top_n = (None, None)):
     '''
     This funtion gets the daily data suitable for time series plots.
@@ -426,24 +1667,18 @@ def prepare_time(continent=None, top_n = (None, None)):
 
     # getting the dataframe prepared with historic data
 
-    df_merged = merge_data()
-
-    df_full = add_calculated_cols(df_merged)
-
-    df = dates_choice(df_full, all_dates=True)
+    df = get_selection('daily')
 
     # defining the beginning of time to be 9th of March 2020
     df = df[df.index > '2020-03-08']
 
+    if continent:
+        df = select_continent(df, continent)
 
-    # list of countries and number of countries
-
-    countries = df.Country.unique()
-
-    tot_countries = df.shape[0]
 
-    # setting a default (key) variable 'var' in case none is provided
+    # setting a default (key) variable 'var' in case none is provided, and all countries
     var = 'Deaths_week'
+    n = None
 
 
     # updating the key variable 'var' and 'n' from the input (optional)
@@ -452,25 +1687,18 @@ def prepare_time(continent=None, top_n = (None, None)):
 
         var = top_n[0]
         n = top_n[1]
-        if n > tot_countries:
-            n = tot_countries
-    else:
-        n = tot_countries
-
-
-    # make list of countries ordered by 'var' at the latest date
-    last_date = df.index.max()
 
-    df_last = df[df.index == last_date].sort_values(var, ascending=False)
 
-    countrylist = list(df_last['Country'][:n])
+    # make list of countries ordered by 'var' at the latest date, from the ranking index
+    countrylist = top_countries(var, n, df.index.max(), 'daily', continent)
 
     # filter df to only contain the countries in the countrylist
-    df = df[df['Country'].isin(countrylist)].reset_index()
+    df = select_countries(df, countrylist).reset_index()
 
     return countrylist, df
 
 
+@timed('prepare_time_weekly')
 def prepare_time_weekly(list_countries=None, continent=None, top_n = (None, None)):
     '''
     This funtion gets the daily data suitable for time series plots - weekly version.
@@ -497,32 +1725,24 @@ def prepare_time_weekly(list_countries=None, continent=None, top_n = (None, None
 
     '''
 
-    # getting the merged dataset
-
-    df_merged = merge_data()
-
-    # filtering on list_countries if provided
+    # getting the dataframe prepared with historic weekly data. The calculated columns are computed
+    # per country, so filtering on list_countries afterwards gives the same result as filtering first.
 
     if list_countries:
-        df_merged = df_merged[df_merged['Country'].isin(list_countries)]
-
-    # getting the dataframe prepared with historic data
-
-    df_full = add_calculated_cols(df_merged)
-
-    df = dates_choice(df_full, all_dates=False, weekly=True)
+        df_full = get_processed_data()
+        df = dates_choice(select_countries(df_full, list_countries), all_dates=False, weekly=True)
+    else:
+        df = get_selection('weekly')
 
     # defining the beginning of time to be 9th of March 2020
     df = df[df.index > '2020-03-08']
 
-    # list of countries and number of countries
-
-    countries = df.Country.unique()
-
-    tot_countries = df.shape[0]
+    if continent:
+        df = select_continent(df, continent)
 
-    # setting a default (key) variable 'var' in case none is provided
+    # setting a default (key) variable 'var' in case none is provided, and all countries
     var = 'Total_deaths'
+    n = None
 
 
     # updating the key variable 'var' and 'n' from the input (optional)
@@ -531,38 +1751,135 @@ def prepare_time_weekly(list_countries=None, continent=None, top_n = (None, None
 
         var = top_n[0]
         n = top_n[1]
-        if n > tot_countries:
-            n = tot_countries
-    else:
-        n = tot_countries
-
 
-    # make list of countries ordered by 'var' at the latest date
-    last_date = df.index.max()
 
-    df_last = df[df.index == last_date].sort_values(var, ascending=False)
-
-    countrylist = list(df_last['Country'][:n])
+    # make list of countries ordered by 'var' at the latest date, from the ranking index
+    countrylist = top_countries(var, n, df.index.max(), 'weekly', continent, list_countries)
 
     df = df.reset_index()
-    df = df[df['Country'].isin(countrylist)]
+    df = select_countries(df, countrylist)
 
 
     return countrylist, df
 
 
-def return_figures():
-    """Creates plotly visualizations
+def series_index(df):
+    '''
+    This function builds a per-country series index of a date selection, so that the series of one country
+    can be taken without filtering the whole dataframe. The rows are sorted by 'Country_id' and date once,
+    and every country gets the slice of the sorted arrays holding its rows, under its name.
+
+    Args:
+        df (dataframe): date selection from dates_choice (Date as index)
+
+    Returns:
+        index (dict): 'Date' and every column as arrays sorted by country and date,
+                      and 'slices' with the slice of every country
+    '''
+
+    codes = df['Country_id'].values
+    dates = df.index.values
+
+    order = np.lexsort((dates, codes))
+    codes = codes[order]
+
+    starts = np.flatnonzero(_segment_starts(codes))
+    ends = np.append(starts[1:], len(codes))
+
+    index = {col: df[col].values[order] for col in df.columns}
+    index['Date'] = pd.DatetimeIndex(dates[order])
+    index['slices'] = {index['Country'][start]: slice(start, end) for start, end in zip(starts, ends)}
+
+    return index
+
+
+def get_series_index(weekly=False):
+    '''
+    This function returns the series index (see 'series_index') of the daily or the weekly data,
+    built once per data version.
+
+    Args:
+        weekly (boolean) (optional): True for the weekly data, False for the daily data
+
+    Returns:
+        index (dict): series index
+    '''
+
+    name = 'weekly' if weekly else 'daily'
+
+    return get_derived(name + '_series', lambda df_full: series_index(get_selection(name)))
+
+
+def country_series(index, country, column, start=None, end=None, budget=None, arrays=False):
+    '''
+    This function gets the dates and the values of one column for one country from a series index.
+
+    Args:
+        index (dict): series index (see 'series_index')
+        country (str): the country
+        column (str): the column to get the values of
+        start (str) (optional): first date to keep
+        end (str) (optional): last date to keep
+        budget (int) (optional): maximum number of points, the series is downsampled with LTTB if longer
+        arrays (boolean) (optional): True to get numpy arrays instead of lists, which the binary payload
+                                     (see 'payload.encode_figure') encodes without going through lists
+
+    Returns:
+        x_val (list): dates
+        y_val (list): values
+    '''
+
+    rows = index['slices'][country]
+    dates = index['Date'][rows]
+
+    first = dates.searchsorted(pd.Timestamp(start)) if start else 0
+    last = dates.searchsorted(pd.Timestamp(end), side='right') if end else len(dates)
+
+    dates = dates[first:last]
+    values = index[column][rows][first:last]
+
+    if budget and len(dates) > budget:
+        keep = lttb(dates.asi8, values, budget)
+        dates, values = dates[keep], values[keep]
+
+    if arrays:
+        return dates.values, values
+
+    return dates.tolist(), values.tolist()
+
+
+def series_window(start=None, end=None):
+    '''
+    This function gets the date window and the point budget of a time series figure. Without a window the
+    figure shows everything from TIME_SERIES_START, downsampled to POINT_BUDGET points per trace; a window
+    (when zooming in) is sent at full resolution.
+
+    Args:
+        start (str) (optional): first date of the window
+        end (str) (optional): last date of the window
+
+    Returns:
+        start (Timestamp), end (str), budget (int)
+    '''
+
+    budget = None if start or end else POINT_BUDGET
+
+    start = max(pd.Timestamp(start or TIME_SERIES_START), pd.Timestamp(TIME_SERIES_START))
+
+    return start, end, budget
+
+
+def figure_one():
+    """Creates the world map of total deaths
 
     Args:
         None
 
     Returns:
-        list (dict): list containing plotly visualizations
+        dict: plotly visualization
 
     """
 
-
     graph_one = []
     df = prepare_barplot()
     df = df.reset_index()
@@ -594,14 +1911,31 @@ def return_figures():
             )
         )
 
+    return dict(data=graph_one, layout=layout_one)
+
+
+def figure_two(start=None, end=None):
+    """Creates the time series of total deaths, top 15 countries
+
+    Args:
+        start (str) (optional): first date of a zoomed-in window
+        end (str) (optional): last date of a zoomed-in window
+
+    Returns:
+        dict: plotly visualization
+
+    """
+
     graph_two = []
-    countrylist, df = prepare_time(top_n = ('Total_deaths', 15))
+    # the top countries at the latest date, from the ranking index; the series come from the series index
+    countrylist = top_countries('Total_deaths', 15, kind='daily')
+
+    start, end, budget = series_window(start, end)
 
-    #df = df[df.Country.isin(countrylist)]
+    series = get_series_index(weekly=False)
 
     for country in countrylist:
-      x_val = df[df['Country'] == country].Date.tolist()
-      y_val =  df[df['Country'] == country].Total_deaths.tolist()
+      x_val, y_val = country_series(series, country, 'Total_deaths', start, end, budget, arrays=PAYLOAD == 'binary')
       graph_two.append(
           go.Scatter(
           x = x_val,
@@ -616,6 +1950,19 @@ def return_figures():
                 yaxis = dict(title = 'Deaths'),
                 xaxis_rangeslider_visible=True)
 
+    return dict(data=graph_two, layout=layout_two)
+
+
+def figure_three():
+    """Creates the world map of total deaths per 100,000
+
+    Args:
+        None
+
+    Returns:
+        dict: plotly visualization
+
+    """
 
     graph_three = []
     df = prepare_barplot()
@@ -647,16 +1994,30 @@ def return_figures():
             )
         )
 
+    return dict(data=graph_three, layout=layout_three)
+
+
+def figure_four(start=None, end=None):
+    """Creates the time series of total deaths per 100,000, top 10 countries
+
+    Args:
+        start (str) (optional): first date of a zoomed-in window
+        end (str) (optional): last date of a zoomed-in window
+
+    Returns:
+        dict: plotly visualization
 
+    """
 
     graph_four = []
-    countrylist, df = prepare_time(top_n = ('Total_deaths_per_100k', 10))
+    countrylist = top_countries('Total_deaths_per_100k', 10, kind='daily')
 
-    #df = df[df.Country.isin(countrylist)]
+    start, end, budget = series_window(start, end)
+
+    series = get_series_index(weekly=False)
 
     for country in countrylist:
-      x_val = df[df['Country'] == country].Date.tolist()
-      y_val =  df[df['Country'] == country].Total_deaths_per_100k.tolist()
+      x_val, y_val = country_series(series, country, 'Total_deaths_per_100k', start, end, budget, arrays=PAYLOAD == 'binary')
       graph_four.append(
           go.Scatter(
           x = x_val,
@@ -671,16 +2032,30 @@ def return_figures():
                 yaxis = dict(title = 'Deaths'),
                 xaxis_rangeslider_visible=True)
 
+    return dict(data=graph_four, layout=layout_four)
+
+
+def figure_five(start=None, end=None):
+    """Creates the time series of weekly deaths, top 10 countries
+
+    Args:
+        start (str) (optional): first date of a zoomed-in window
+        end (str) (optional): last date of a zoomed-in window
+
+    Returns:
+        dict: plotly visualization
 
+    """
 
     graph_five = []
-    countrylist, df = prepare_time_weekly(list_countries=None, top_n = ('Deaths_week', 10))
+    countrylist = top_countries('Deaths_week', 10, kind='weekly')
 
-    #df = df[df.Country.isin(countrylist)]
+    start, end, budget = series_window(start, end)
+
+    series = get_series_index(weekly=True)
 
     for country in countrylist:
-      x_val = df[df['Country'] == country].Date.tolist()
-      y_val =  df[df['Country'] == country].Deaths.tolist()
+      x_val, y_val = country_series(series, country, 'Deaths', start, end, budget, arrays=PAYLOAD == 'binary')
       graph_five.append(
           go.Scatter(
           x = x_val,
@@ -695,17 +2070,63 @@ def return_figures():
                 yaxis = dict(title = 'Deaths'),
                 xaxis_rangeslider_visible=True)
 
+    return dict(data=graph_five, layout=layout_five)
+
+
+# the figures of the dashboard, in the order they are shown
+FIGURES = [figure_one, figure_two, figure_three, figure_four, figure_five]
+
+# the time series figures, which take a date window (start, end)
+SERIES_FIGURES = [figure_two, figure_four, figure_five]
+
+
+def return_figure(i, **window):
+    """Creates one plotly visualization
+
+    Args:
+        i (int): index of the figure in FIGURES
+        window (optional): start and end of a zoomed-in date window, for the SERIES_FIGURES
+
+    Returns:
+        dict: plotly visualization
+
+    """
+
+    with timer('pandemic_figure_seconds', figure=i):
+        return FIGURES[i](**window)
+
+
+def return_figures(indices=None, workers=FIGURE_WORKERS, pool=FIGURE_POOL):
+    """Creates plotly visualizations
+
+    The figures are independent of each other once the processed dataset is loaded, so with workers they
+    are built in parallel, and a cold build takes about as long as the slowest figure. The dataset is
+    loaded before the workers start. Threads share it (and the artifacts derived from it) directly; forked
+    processes share the memory of this process copy-on-write, and only send their figures back. Processes
+    avoid the GIL but build their own derived artifacts, which are lost when they finish.
+
+    Args:
+        indices (list) (optional): indexes of the figures in FIGURES, all if None
+        workers (int) (optional): number of workers, 0 to build the figures one by one
+        pool (str) (optional): 'thread' or 'process'
+
+    Returns:
+        list (dict): list containing plotly visualizations
 
+    """
 
+    if indices is None:
+        indices = range(len(FIGURES))
 
-    # append all charts to the figures list
-    figures = []
+    if not workers or len(indices) < 2:
+        return [return_figure(i) for i in indices]
 
-    figures.append(dict(data=graph_one, layout=layout_one))
-    figures.append(dict(data=graph_two, layout=layout_two))
-    figures.append(dict(data=graph_three, layout=layout_three))
-    figures.append(dict(data=graph_four, layout=layout_four))
-    figures.append(dict(data=graph_five, layout=layout_five))
+    get_processed_data()
 
+    if pool == 'process':
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='figure')
 
-    return figures
+    with executor:
+        return list(executor.map(return_figure, indices))